@@ -2,16 +2,23 @@
 A much shorter version of train.py for benchmarking
 """
 import os
+import resource
+import itertools
 from contextlib import nullcontext
 import numpy as np
 import time
 import torch
 from model import GPTConfig, GPT
+from loader import BatchLoader
+from dataset import open_tokens
 
 # -----------------------------------------------------------------------------
 batch_size = 12
 block_size = 1024
 bias = False
+loss_chunk_size = 0 # if > 0, compute lm_head + loss in chunks of this many tokens, if set also benchmarks without it to report memory saved vs. time overhead
+activation_checkpoint = '' # '', 'block' or 'attn', if set also benchmarks without it to report memory saved vs. time overhead
+activation_checkpoint_every = 1
 real_data = True
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
@@ -33,14 +40,9 @@ ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=
 if real_data:
     dataset = 'openwebtext'
     data_dir = os.path.join('data', dataset)
-    train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    def get_batch(split):
-        data = train_data # note ignore split in benchmarking script
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-        return x, y
+    train_data = open_tokens(data_dir, 'train')
+    loader = BatchLoader(train_data, block_size, batch_size, device, seed=seed)
+    get_batch = lambda split: next(loader) # note ignore split in benchmarking script
 else:
     # alternatively, if fixed data is desired to not care about data loading
     x = torch.randint(50304, (batch_size, block_size), device=device)
@@ -53,6 +55,9 @@ gptconf = GPTConfig(
     n_layer = 12, n_head = 12, n_embd = 768, # size of the model
     dropout = 0, # for determinism
     bias = bias,
+    loss_chunk_size = loss_chunk_size,
+    activation_checkpoint = activation_checkpoint,
+    activation_checkpoint_every = activation_checkpoint_every,
 )
 model = GPT(gptconf)
 model.to(device)
@@ -96,22 +101,52 @@ if profile:
 else:
 
     # simple benchmarking
-    torch.cuda.synchronize()
-    for stage, num_steps in enumerate([10, 20]): # burnin, then benchmark
-        t0 = time.time()
-        X, Y = get_batch('train')
-        for k in range(num_steps):
-            with ctx:
-                logits, loss = model(X, Y)
+    sync = torch.cuda.synchronize if device_type == 'cuda' else lambda: None
+    results = {}
+    # with activation checkpointing and/or a chunked loss, benchmark with and without each of them. the
+    # runs with them go first, because on cpu we can only observe the peak memory of the whole process so far
+    modes = [activation_checkpoint, ''] if activation_checkpoint else ['']
+    chunks = [loss_chunk_size, 0] if loss_chunk_size > 0 else [0]
+    for mode, chunk in itertools.product(modes, chunks):
+        model.config.activation_checkpoint = mode
+        model.config.loss_chunk_size = chunk
+        if device_type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        sync()
+        for stage, num_steps in enumerate([10, 20]): # burnin, then benchmark
+            t0 = time.time()
+            wait_time0 = loader.wait_time if real_data else 0.0
             X, Y = get_batch('train')
-            optimizer.zero_grad(set_to_none=True)
-            loss.backward()
-            optimizer.step()
-            lossf = loss.item()
-            print(f"{k}/{num_steps} loss: {lossf:.4f}")
-        torch.cuda.synchronize()
-        t1 = time.time()
-        dt = t1-t0
-        mfu = model.estimate_mfu(batch_size * 1 * num_steps, dt)
-        if stage == 1:
-            print(f"time per iteration: {dt/num_steps*1000:.4f}ms, MFU: {mfu*100:.2f}%")
+            for k in range(num_steps):
+                with ctx:
+                    logits, loss = model(X, Y)
+                X, Y = get_batch('train')
+                optimizer.zero_grad(set_to_none=True)
+                loss.backward()
+                optimizer.step()
+                lossf = loss.item()
+                print(f"{k}/{num_steps} loss: {lossf:.4f}")
+            sync()
+            t1 = time.time()
+            dt = t1-t0
+            data_wait = (loader.wait_time if real_data else 0.0) - wait_time0
+            mfu = model.estimate_mfu(batch_size * 1 * num_steps, dt)
+            if stage == 1:
+                if device_type == 'cuda':
+                    peak = torch.cuda.max_memory_allocated(device) / 1024**3
+                else:
+                    # on cpu, the best we have is the peak resident set size of the whole process
+                    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024**2
+                results[mode, chunk] = (dt/num_steps, peak)
+                print(f"activation_checkpoint={mode!r}, loss_chunk_size={chunk}: time per iteration: {dt/num_steps*1000:.4f}ms, "
+                      f"MFU: {mfu*100:.2f}%, peak memory: {peak:.2f} GiB, data wait: {data_wait/num_steps*1000:.2f}ms")
+    if activation_checkpoint:
+        (dt_ckpt, peak_ckpt), (dt_base, peak_base) = results[activation_checkpoint, loss_chunk_size], results['', loss_chunk_size]
+        print(f"activation_checkpoint={activation_checkpoint!r} (every {activation_checkpoint_every}): "
+              f"saves {peak_base - peak_ckpt:.2f} GiB of peak memory ({(1 - peak_ckpt/peak_base)*100:.1f}%) "
+              f"for {(dt_ckpt/dt_base - 1)*100:+.1f}% time per iteration")
+    if loss_chunk_size > 0:
+        (dt_chunk, peak_chunk), (dt_base, peak_base) = results[activation_checkpoint, loss_chunk_size], results[activation_checkpoint, 0]
+        print(f"loss_chunk_size={loss_chunk_size}: peak memory {peak_chunk:.2f} GiB vs. {peak_base:.2f} GiB without, "
+              f"saves {peak_base - peak_chunk:.2f} GiB ({(1 - peak_chunk/peak_base)*100:.1f}%) "
+              f"for {(dt_chunk/dt_base - 1)*100:+.1f}% time per iteration")
@@ -0,0 +1,215 @@
+# fmt: off
+
+"""
+A benchmark suite for training speed and memory, to catch regressions from upgrading PyTorch or
+changing this repo. It runs a training iteration (forward, backward, optimizer step) on random
+tokens for every combination in a matrix of model sizes, batch_size, block_size, dtype, compile
+and device, and times the three phases separately after some warmup iterations. Every combination
+runs in a fresh process, so its peak memory is its own (on cpu: the peak RSS of that process) and
+a crash or an out-of-memory only fails that one. Without isolate, the peak RSS on cpu would be the
+maximum over all earlier entries too, so it isn't recorded (None) and not compared.
+
+Results go to a JSON file, and a later run can compare itself against one: it fails (exit code 1)
+if any of the check metrics got worse by more than threshold, e.g. 10% slower.
+$ python benchmark.py config/bench_cpu.py --out=bench_before.json
+$ python benchmark.py config/bench_cpu.py --out=bench_after.json --compare_to=bench_before.json
+
+Every matrix entry is a tuple, also on the command line, e.g. --batch_size="(8, 16)".
+"""
+import os
+import sys
+import json
+import time
+import platform
+import resource
+import itertools
+import subprocess
+import statistics
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+
+import torch
+
+from model import GPTConfig, GPT
+
+model_sizes = {
+    'tiny': dict(n_layer=2, n_head=2, n_embd=128),
+    'baby': dict(n_layer=6, n_head=6, n_embd=384), # the shakespeare_char model
+    'gpt2': dict(n_layer=12, n_head=12, n_embd=768), # 124M params
+    'gpt2-medium': dict(n_layer=24, n_head=16, n_embd=1024), # 350M params
+    'gpt2-large': dict(n_layer=36, n_head=20, n_embd=1280), # 774M params
+    'gpt2-xl': dict(n_layer=48, n_head=25, n_embd=1600), # 1558M params
+}
+# the fields that identify a benchmark, the same ones are compared between runs
+matrix_keys = ('model', 'batch_size', 'block_size', 'dtype', 'compile', 'device')
+# for every metric, whether higher is better
+metrics = {'iter_ms': False, 'fwd_ms': False, 'bwd_ms': False, 'opt_ms': False, 'tokens_per_sec': True, 'peak_mem_mb': False}
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize(device)
+    elif device.startswith('mps'):
+        torch.mps.synchronize()
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(p / 100 * len(xs)))] if xs else None
+
+def run(bench, vocab_size=50304, warmup_iters=5, iters=10, seed=1337):
+    """ benchmark the training iteration of one entry of the matrix, returns its metrics """
+    device = bench['device']
+    device_type = 'cuda' if 'cuda' in device else 'cpu'
+    torch.manual_seed(seed)
+    torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+    torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+    if device_type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[bench['dtype']]
+    # unlike train.py, also autocast on cpu, to benchmark its bfloat16 kernels
+    ctx = nullcontext() if ptdtype == torch.float32 else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+    scaler = torch.amp.GradScaler(device_type, enabled=(bench['dtype'] == 'float16'))
+
+    config = GPTConfig(block_size=bench['block_size'], vocab_size=vocab_size, dropout=0.0, bias=False, **model_sizes[bench['model']])
+    model = GPT(config).to(device)
+    optimizer = model.configure_optimizers(weight_decay=1e-1, learning_rate=6e-4, betas=(0.9, 0.95), device_type=device_type)
+    if bench['compile']:
+        model = torch.compile(model)
+    X, Y = torch.randint(vocab_size, (2, bench['batch_size'], bench['block_size']), device=device)
+
+    times = [] # (forward, backward, optimizer) of every timed iteration
+    for k in range(warmup_iters + iters):
+        synchronize(device)
+        t0 = time.perf_counter()
+        with ctx:
+            _, loss = model(X, Y)
+        synchronize(device)
+        t1 = time.perf_counter()
+        scaler.scale(loss).backward()
+        synchronize(device)
+        t2 = time.perf_counter()
+        scaler.step(optimizer)
+        scaler.update()
+        optimizer.zero_grad(set_to_none=True)
+        synchronize(device)
+        t3 = time.perf_counter()
+        if k >= warmup_iters:
+            times.append((t1 - t0, t2 - t1, t3 - t2))
+
+    if device_type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(device)
+    else:
+        # the best we have on cpu is the peak resident set size of the process, kB on linux, bytes on macos
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    # medians, which a few slow iterations (e.g. another process on the machine) don't move
+    fwd, bwd, opt = (statistics.median(t) for t in zip(*times))
+    dt = statistics.median(sum(t) for t in times)
+    raw_model = model._orig_mod if bench['compile'] else model
+    return {
+        'iter_ms': dt * 1000, 'fwd_ms': fwd * 1000, 'bwd_ms': bwd * 1000, 'opt_ms': opt * 1000,
+        'tokens_per_sec': bench['batch_size'] * bench['block_size'] / dt,
+        'mfu': raw_model.estimate_mfu(bench['batch_size'], dt), # relative to an A100, only meaningful on one
+        'peak_mem_mb': peak / 1024**2,
+        'params': raw_model.get_num_params(),
+    }
+
+def environment():
+    """ what the results depend on besides the code of the benchmark """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'torch': torch.__version__, 'python': platform.python_version(), 'platform': platform.platform(),
+        'cpu_count': os.cpu_count(), 'threads': torch.get_num_threads(), 'commit': commit,
+        'cuda': [torch.cuda.get_device_name(i) for i in range(torch.cuda.device_count())],
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+    }
+
+def compare(results, baseline, check, threshold, keys=matrix_keys, metrics=metrics):
+    """ prints how every metric changed against the baseline, and returns the regressions in check """
+    regressions = []
+    before = {tuple(r[k] for k in keys): r for r in baseline['results']}
+    for r in results:
+        key = tuple(r[k] for k in keys)
+        name = ' '.join(f'{k}={r[k]}' for k in keys)
+        if key not in before:
+            print(f"{name}: not in the baseline")
+            continue
+        b = before[key]
+        if 'error' in r or 'error' in b:
+            if 'error' in r and 'error' not in b:
+                regressions.append(f"{name}: failed with {r['error']}")
+            print(f"{name}: {r.get('error', 'ok')} (baseline: {b.get('error', 'ok')})")
+            continue
+        changes = []
+        for metric, higher_is_better in metrics.items():
+            if r[metric] is None or b[metric] is None: # not measured, e.g. peak_mem_mb without isolate on cpu
+                changes.append(f"{metric} n/a")
+                continue
+            change = r[metric] / b[metric] - 1 if b[metric] else 0.0
+            worse = -change if higher_is_better else change
+            changes.append(f"{metric} {change*100:+.1f}%")
+            if metric in check and worse > threshold:
+                regressions.append(f"{name}: {metric} {b[metric]:.2f} -> {r[metric]:.2f} ({change*100:+.1f}%)")
+        print(f"{name}: " + ', '.join(changes))
+    return regressions
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    model = ('tiny', 'gpt2') # keys of model_sizes
+    batch_size = (8,)
+    block_size = (256,)
+    dtype = ('float32',) # 'float32', 'bfloat16' or 'float16'
+    compile = (False,)
+    device = ('cuda',) if torch.cuda.is_available() else ('cpu',)
+    warmup_iters = 5 # not timed, includes compiling
+    iters = 10 # timed
+    isolate = True # every benchmark in a fresh process
+    out = 'bench.json'
+    compare_to = '' # a JSON file of an earlier run to check against
+    check = ('iter_ms', 'peak_mem_mb') # the metrics that fail the run if they regress
+    threshold = 0.1 # how much worse a check metric may get, relatively
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    assert all(m in model_sizes for m in model), f"models are {', '.join(model_sizes)}"
+    benches = [dict(zip(matrix_keys, values)) for values in itertools.product(model, batch_size, block_size, dtype, compile, device)]
+    results = []
+    for i, bench in enumerate(benches):
+        name = ' '.join(f'{k}={v}' for k, v in bench.items())
+        if bench['device'].startswith('cuda') and not torch.cuda.is_available():
+            print(f"[{i+1}/{len(benches)}] {name}: skipped, no cuda")
+            continue
+        try:
+            if isolate:
+                # spawn, not fork: a fresh process, without the memory or the cuda context of this one
+                with ProcessPoolExecutor(1, mp_context=mp.get_context('spawn')) as pool:
+                    result = pool.submit(run, bench, warmup_iters=warmup_iters, iters=iters).result()
+            else:
+                result = run(bench, warmup_iters=warmup_iters, iters=iters)
+                if not bench['device'].startswith('cuda'):
+                    result['peak_mem_mb'] = None # the peak RSS of this process, i.e. of all entries so far
+            mem = f"{result['peak_mem_mb']:,.0f}MB" if result['peak_mem_mb'] is not None else 'n/a'
+            print(f"[{i+1}/{len(benches)}] {name}: {result['iter_ms']:.2f}ms/iter (forward {result['fwd_ms']:.2f}ms, "
+                  f"backward {result['bwd_ms']:.2f}ms, optimizer {result['opt_ms']:.2f}ms), "
+                  f"{result['tokens_per_sec']:,.0f} tokens/s, peak memory {mem}")
+        except Exception as e: # e.g. out of memory, or the process died: record it and go on
+            result = {'error': f'{type(e).__name__}: {e}'}
+            print(f"[{i+1}/{len(benches)}] {name}: {result['error']}")
+        results.append({**bench, **result})
+
+    with open(out, 'w') as f:
+        json.dump({'environment': environment(), 'warmup_iters': warmup_iters, 'iters': iters, 'results': results}, f, indent=1)
+    print(f"results written to {out}")
+
+    if compare_to:
+        with open(compare_to) as f:
+            baseline = json.load(f)
+        print(f"compared to {compare_to} (torch {baseline['environment']['torch']}, commit {baseline['environment']['commit']}):")
+        regressions = compare(results, baseline, check, threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) of more than {threshold*100:.0f}%:")
+            for r in regressions:
+                print("  " + r)
+            sys.exit(1)
+        print(f"no regressions of more than {threshold*100:.0f}%")
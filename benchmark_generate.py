@@ -0,0 +1,119 @@
+# fmt: off
+
+"""
+Benchmark generation, to size a sampling deployment and to check that changes to decoding help.
+For every combination of prompt_length, batch_size, max_new_tokens and use_kv_cache it generates
+from random prompts a few times and measures
+- the time to first token (ttft): the prefill of the prompts and sampling the first tokens
+- the latency of every further token, i.e. the time between consecutive tokens, of which the
+  50th/95th/99th percentiles (over all tokens of all repeats) show the jitter of the decode steps
+- the throughput: generated tokens per second over the whole batch, overall and in the decode phase
+Results go to a JSON file and, as in benchmark.py, --compare_to=an earlier one fails on regressions:
+$ python benchmark_generate.py --out_dir=out-shakespeare-char --device=cpu
+$ python benchmark_generate.py --init_from=gpt2 --prompt_length="(128, 512)" --batch_size="(1, 16)"
+$ python benchmark_generate.py --init_from=int8 --out_dir=out --compare_to=bench_generate.json
+"""
+import sys
+import json
+import time
+import itertools
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+
+from sample import load_model
+from benchmark import synchronize, percentile, environment, compare
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir), 'export' or 'int8' (exported/quantized model in out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is a gpt2 variant
+prompt_length = (16, 256) # tokens of every prompt
+batch_size = (1, 8) # prompts generated from together
+max_new_tokens = (128,)
+use_kv_cache = (True,)
+temperature = 0.8
+top_k = 200
+warmup = 1 # untimed generations of every entry
+repeats = 5 # timed generations of every entry
+seed = 1337
+device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+compile = False # use PyTorch 2.0 to compile the model to be faster
+out = 'bench_generate.json'
+compare_to = '' # a JSON file of an earlier run to check against
+check = ('ttft_ms_p50', 'token_ms_p50', 'tokens_per_sec') # the metrics that fail the run if they regress
+threshold = 0.1 # how much worse a check metric may get, relatively
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+assert all(n >= 2 for n in max_new_tokens), "the latency per token needs max_new_tokens >= 2"
+keys = ('prompt_length', 'batch_size', 'max_new_tokens', 'use_kv_cache')
+# for every metric, whether higher is better
+metrics = {'ttft_ms_p50': False, 'ttft_ms_p95': False, 'token_ms_p50': False, 'token_ms_p95': False, 'token_ms_p99': False,
+           'tokens_per_sec': True, 'decode_tokens_per_sec': True}
+
+torch.manual_seed(seed)
+torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+model, _ = load_model(init_from, out_dir, device)
+if compile:
+    model = torch.compile(model) # requires PyTorch 2.0 (optional)
+
+def generate(x, n, use_kv_cache):
+    """ generates n tokens after the prompts x, returns the times after starting at which every one of them arrived """
+    synchronize(device)
+    t0 = time.perf_counter()
+    times = []
+    with ctx:
+        # generate yields every token with .item(), a device sync, so it has been computed by then
+        for _ in model.generate(x, n, temperature=temperature, top_k=top_k, use_kv_cache=use_kv_cache):
+            times.append(time.perf_counter() - t0)
+    return np.array(times)
+
+results = []
+benches = [dict(zip(keys, values)) for values in itertools.product(prompt_length, batch_size, max_new_tokens, use_kv_cache)]
+for i, bench in enumerate(benches):
+    b, n = bench['batch_size'], bench['max_new_tokens']
+    x = torch.randint(model.config.vocab_size, (b, bench['prompt_length']), device=device)
+    for _ in range(warmup):
+        generate(x, n, bench['use_kv_cache'])
+    runs = [generate(x, n, bench['use_kv_cache']) for _ in range(repeats)]
+    ttft = [t[0] * 1000 for t in runs]
+    latency = np.concatenate([np.diff(t) for t in runs]) * 1000 # between consecutive tokens
+    total, decode = sum(t[-1] for t in runs), sum(t[-1] - t[0] for t in runs)
+    result = {
+        **bench,
+        'ttft_ms_p50': percentile(ttft, 50), 'ttft_ms_p95': percentile(ttft, 95), 'ttft_ms_p99': percentile(ttft, 99),
+        'token_ms_p50': percentile(latency, 50), 'token_ms_p95': percentile(latency, 95), 'token_ms_p99': percentile(latency, 99),
+        'token_ms_mean': float(latency.mean()),
+        'tokens_per_sec': repeats * b * n / total, # every step generates a token for every prompt
+        'decode_tokens_per_sec': repeats * b * (n - 1) / decode,
+        'prefill_tokens_per_sec': b * bench['prompt_length'] / (percentile(ttft, 50) / 1000),
+    }
+    results.append(result)
+    print(f"[{i+1}/{len(benches)}] {' '.join(f'{k}={v}' for k, v in bench.items())}: "
+          f"ttft {result['ttft_ms_p50']:.2f}ms, per token p50 {result['token_ms_p50']:.2f}ms p95 {result['token_ms_p95']:.2f}ms "
+          f"p99 {result['token_ms_p99']:.2f}ms, {result['tokens_per_sec']:,.0f} tokens/s ({result['decode_tokens_per_sec']:,.0f} decoding)")
+
+setup = {'init_from': init_from, 'out_dir': out_dir, 'params': model.get_num_params(), 'block_size': model.config.block_size,
+         'device': device, 'dtype': dtype if device_type != 'cpu' else 'float32', # no autocast on cpu
+         'compile': compile, 'temperature': temperature, 'top_k': top_k}
+with open(out, 'w') as f:
+    json.dump({'environment': environment(), 'setup': setup, 'warmup': warmup, 'repeats': repeats, 'results': results}, f, indent=1)
+print(f"results written to {out}")
+
+if compare_to:
+    with open(compare_to) as f:
+        baseline = json.load(f)
+    print(f"compared to {compare_to} (torch {baseline['environment']['torch']}, commit {baseline['environment']['commit']}):")
+    regressions = compare(results, baseline, check, threshold, keys, metrics)
+    if regressions:
+        print(f"{len(regressions)} regression(s) of more than {threshold*100:.0f}%:")
+        for r in regressions:
+            print("  " + r)
+        sys.exit(1)
+    print(f"no regressions of more than {threshold*100:.0f}%")
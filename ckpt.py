@@ -0,0 +1,400 @@
+# fmt: off
+
+"""
+A simple zero-copy checkpoint format. A file is an 8-byte little-endian header length, a JSON
+header, and then the raw bytes of every tensor, each aligned to 64 bytes. The header holds the
+(nested dict/list) structure of the saved object, with every tensor replaced by a reference to its
+dtype, shape and offset. Loading memory-maps the file, so tensors are views into the page cache
+and nothing is deserialized beyond the header. Tensors that share memory (the tied wte / lm_head
+weight) are stored once.
+
+A training checkpoint is two such files in out_dir, so that sampling never has to read the
+optimizer state: ckpt_model.bin (weights, model_args, iter_num, ...) and ckpt_optim.bin.
+With a sharded (ZeRO) optimizer, every rank instead writes the state of the parameters it owns to
+ckpt_optim.{rank}-of-{world_size}.bin, keyed by parameter name so it can be loaded by any number of ranks.
+With FSDP, a checkpoint is either gathered into the above ('full', see full_state_dict), or written
+by all ranks in parallel to out_dir/ckpt_sharded with torch.distributed.checkpoint ('sharded'), next to
+the usual files that then hold everything but the weights and the optimizer state.
+An inference export is a single model.bin with only the weights, in the dtype of choice.
+AsyncCheckpointer writes checkpoints (in either this format or as a pickled ckpt.pt) on a
+background thread, so that training doesn't stall while they are serialized.
+
+Export a checkpoint (either format) for sampling, and compare the cold load times:
+$ python ckpt.py --out_dir=out-shakespeare-char --dtype=bfloat16
+
+This writes out_dir/model.bin, which sample.py and serve.py load with --init_from=export.
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import struct
+import threading
+
+import torch
+
+from model import GPTConfig, GPT
+
+ALIGN = 64
+
+def _flatten(obj, tensors, seen):
+    # replace every tensor in obj by a reference to an entry of tensors, deduplicating shared ones
+    if isinstance(obj, torch.Tensor):
+        key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), tuple(obj.shape), obj.stride(), obj.dtype)
+        if key not in seen:
+            seen[key] = len(tensors)
+            tensors.append(obj)
+        return {'__tensor__': seen[key]}
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {k: _flatten(v, tensors, seen) for k, v in obj.items()}
+        # e.g. the integer keys of an optimizer state, which JSON would turn into strings
+        return {'__items__': [[k, _flatten(v, tensors, seen)] for k, v in obj.items()]}
+    if isinstance(obj, tuple):
+        return {'__tuple__': [_flatten(v, tensors, seen) for v in obj]} # e.g. the betas of AdamW
+    if isinstance(obj, list):
+        return [_flatten(v, tensors, seen) for v in obj]
+    return obj
+
+def _unflatten(obj, tensors):
+    if isinstance(obj, dict):
+        if '__tensor__' in obj:
+            return tensors[obj['__tensor__']]
+        if '__items__' in obj:
+            return {k: _unflatten(v, tensors) for k, v in obj['__items__']}
+        if '__tuple__' in obj:
+            return tuple(_unflatten(v, tensors) for v in obj['__tuple__'])
+        return {k: _unflatten(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_unflatten(v, tensors) for v in obj]
+    return obj
+
+def save(obj, path):
+    """ save a nested dict/list of tensors and JSON-able values, atomically via a temp file """
+    tensors = []
+    structure = _flatten(obj, tensors, {})
+    entries, offset = [], 0
+    for t in tensors:
+        nbytes = t.numel() * t.element_size()
+        entries.append({'dtype': str(t.dtype).removeprefix('torch.'), 'shape': list(t.shape), 'offset': offset})
+        offset += (nbytes + ALIGN - 1) // ALIGN * ALIGN
+    header = json.dumps({'structure': structure, 'tensors': entries}).encode()
+    # pad the header so that the tensor data starts aligned
+    header += b' ' * (-(8 + len(header)) % ALIGN)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for t, entry in zip(tensors, entries):
+            data = t.detach().contiguous().cpu().reshape(-1).view(torch.uint8).numpy()
+            f.write(data.data)
+            f.write(b'\0' * (-len(data) % ALIGN))
+    os.replace(tmp_path, path)
+
+def load(path):
+    """ load a file written by save(), all tensors are (copy-on-write) memory-mapped on the cpu """
+    with open(path, 'rb') as f:
+        n = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(n))
+    start = 8 + n
+    size = os.path.getsize(path)
+    # MAP_PRIVATE: pages are read from the page cache on first touch, writes stay in this process
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=size)
+    tensors = []
+    for entry in header['tensors']:
+        dtype = getattr(torch, entry['dtype'])
+        itemsize = torch.empty((), dtype=dtype).element_size()
+        t = torch.empty(0, dtype=dtype)
+        t.set_(storage, (start + entry['offset']) // itemsize, entry['shape'])
+        tensors.append(t)
+    return _unflatten(header['structure'], tensors)
+
+def exists(out_dir):
+    return os.path.exists(os.path.join(out_dir, 'ckpt_model.bin'))
+
+def is_latest(out_dir):
+    """ whether out_dir has a checkpoint in this format that is not older than its ckpt.pt, if any """
+    if not exists(out_dir):
+        return False
+    # an out_dir can have both if it was trained on with the other ckpt_format later, take the newer one
+    torch_path = os.path.join(out_dir, 'ckpt.pt')
+    return not os.path.exists(torch_path) or \
+        os.path.getmtime(os.path.join(out_dir, 'ckpt_model.bin')) >= os.path.getmtime(torch_path)
+
+def save_checkpoint(checkpoint, out_dir):
+    """ write a train.py checkpoint dict as out_dir/ckpt_model.bin and out_dir/ckpt_optim.bin """
+    checkpoint = dict(checkpoint)
+    optimizer = checkpoint.pop('optimizer', None)
+    if optimizer is not None:
+        # the two files are replaced one after the other, the iteration tells whether they belong together
+        save({'optimizer': optimizer, 'iter_num': checkpoint['iter_num']}, os.path.join(out_dir, 'ckpt_optim.bin'))
+    save(checkpoint, os.path.join(out_dir, 'ckpt_model.bin'))
+
+def load_checkpoint(out_dir, optimizer=True):
+    """ the inverse of save_checkpoint, the optimizer state is only read if asked for """
+    checkpoint = load(os.path.join(out_dir, 'ckpt_model.bin'))
+    optim_path = os.path.join(out_dir, 'ckpt_optim.bin')
+    # a ZeRO or sharded FSDP checkpoint keeps its optimizer state elsewhere, a ckpt_optim.bin is from an earlier run
+    own_optimizer = 'optimizer_shards' not in checkpoint and not checkpoint.get('sharded')
+    if optimizer and own_optimizer and os.path.exists(optim_path):
+        optim = load(optim_path)
+        if 'iter_num' in optim: # older files hold only the optimizer state dict
+            assert optim['iter_num'] == checkpoint['iter_num'], \
+                f"{optim_path} is from iteration {optim['iter_num']}, not {checkpoint['iter_num']}"
+            optim = optim['optimizer']
+        checkpoint['optimizer'] = optim
+    return checkpoint
+
+def _local_optimizer(optimizer):
+    # the optimizer that actually holds the state, e.g. the one of this rank inside a ZeroRedundancyOptimizer
+    return getattr(optimizer, 'optim', optimizer)
+
+def optimizer_shard(optimizer, model, iter_num):
+    """
+    The optimizer state of the parameters this rank owns, keyed by parameter name rather than by
+    index, so that it can be re-sharded onto any number of ranks when loading.
+    """
+    names = {id(p): n for n, p in model.named_parameters()}
+    local = _local_optimizer(optimizer)
+    state = {names[id(p)]: local.state[p] for g in local.param_groups for p in g['params'] if p in local.state}
+    return {'state': state, 'iter_num': iter_num}
+
+def shard_path(out_dir, rank, world_size):
+    return os.path.join(out_dir, f'ckpt_optim.{rank}-of-{world_size}.bin')
+
+def load_optimizer_shards(optimizer, model, out_dir, world_size, iter_num):
+    """
+    Load the optimizer state saved as world_size shards (by any number of ranks) into optimizer,
+    a plain optimizer or this rank's ZeroRedundancyOptimizer. The shards are memory-mapped, so
+    only the state of the parameters owned by this rank is actually read.
+    """
+    state = {}
+    for rank in range(world_size):
+        shard = load(shard_path(out_dir, rank, world_size))
+        assert shard['iter_num'] == iter_num, f"optimizer shard {rank} is from iteration {shard['iter_num']}, not {iter_num}"
+        state.update(shard['state'])
+    names = {id(p): n for n, p in model.named_parameters()}
+    local = _local_optimizer(optimizer)
+    # a regular state dict of the local optimizer, whose state is indexed by the order of its parameters
+    state_dict = local.state_dict()
+    params = [p for g in local.param_groups for p in g['params']]
+    state_dict['state'] = {i: state[names[id(p)]] for i, p in enumerate(params) if names[id(p)] in state}
+    local.load_state_dict(state_dict)
+
+def _param_names(optimizer, model):
+    # the names of the parameters, in the order of the indices of optimizer.state_dict()
+    names = {id(p): n for n, p in model.named_parameters()}
+    return [names[id(p)] for g in optimizer.param_groups for p in g['params']]
+
+def full_state_dict(model, optimizer):
+    """
+    Gather the model and optimizer state of an FSDP-sharded GPT onto the cpu of rank 0. All ranks
+    have to call this, the others get empty dicts. The result has the same form as the state_dict()
+    of an unsharded model and optimizer, so that the checkpoint can be resumed with or without FSDP.
+    """
+    from torch.distributed.checkpoint.state_dict import get_state_dict, StateDictOptions
+    model_sd, optim_sd = get_state_dict(model, optimizer, options=StateDictOptions(full_state_dict=True, cpu_offload=True))
+    if not model_sd:
+        return {}, {}
+    # the tied wte / lm_head weight is gathered as two copies, share them again so it is saved once
+    model_sd['lm_head.weight'] = model_sd['transformer.wte.weight']
+    # the optimizer state comes keyed by parameter name, key it by index like optimizer.state_dict()
+    index = {n: i for i, n in enumerate(_param_names(optimizer, model))}
+    optim_sd = {
+        'state': {index[n]: s for n, s in optim_sd['state'].items()},
+        'param_groups': [dict(g, params=[index[n] for n in g['params']]) for g in optim_sd['param_groups']],
+    }
+    return model_sd, optim_sd
+
+def load_full_optimizer_state_dict(optimizer, model, state_dict):
+    """ load a regular optimizer.state_dict() into the optimizer of an FSDP-sharded GPT, on every rank """
+    from torch.distributed.checkpoint.state_dict import set_optimizer_state_dict, StateDictOptions
+    names = _param_names(optimizer, model)
+    state_dict = {
+        'state': {names[i]: s for i, s in state_dict['state'].items()},
+        'param_groups': [dict(g, params=[names[i] for i in g['params']]) for g in state_dict['param_groups']],
+    }
+    set_optimizer_state_dict(model, optimizer, state_dict, options=StateDictOptions(full_state_dict=True))
+
+def save_sharded(model, optimizer, out_dir, iter_num):
+    """
+    Save the model and optimizer state of an FSDP-sharded GPT to out_dir/ckpt_sharded with
+    torch.distributed.checkpoint: every rank writes only its own shards, in parallel, and nothing is
+    gathered. All ranks have to call this. The checkpoint can be loaded by any number of ranks.
+    """
+    import torch.distributed.checkpoint as dcp
+    from torch.distributed.checkpoint.state_dict import get_state_dict
+    model_sd, optim_sd = get_state_dict(model, optimizer)
+    state = {'model': model_sd, 'optimizer': optim_sd, 'iter_num': iter_num}
+    dcp.save(state, checkpoint_id=os.path.join(out_dir, 'ckpt_sharded'))
+
+def load_sharded(model, optimizer, out_dir, iter_num):
+    """
+    Load a checkpoint written by save_sharded into a model, sharded or not, and its optimizer (or
+    None for just the weights). Every rank reads only what it needs for its own shards.
+    """
+    import torch.distributed.checkpoint as dcp
+    from torch.distributed.checkpoint.state_dict import get_state_dict, set_state_dict, get_model_state_dict, set_model_state_dict
+    if optimizer is not None:
+        model_sd, optim_sd = get_state_dict(model, optimizer)
+        state = {'model': model_sd, 'optimizer': optim_sd, 'iter_num': -1}
+    else:
+        state = {'model': get_model_state_dict(model), 'iter_num': -1}
+    dcp.load(state, checkpoint_id=os.path.join(out_dir, 'ckpt_sharded'))
+    assert state['iter_num'] == iter_num, f"sharded checkpoint is from iteration {state['iter_num']}, not {iter_num}"
+    if optimizer is not None:
+        set_state_dict(model, optimizer, model_state_dict=state['model'], optim_state_dict=state['optimizer'])
+    else:
+        set_model_state_dict(model, state['model'])
+
+def load_sharded_model(out_dir, model_args, iter_num):
+    """ the weights of a checkpoint written by save_sharded, as a regular state_dict on the cpu """
+    with torch.device('meta'):
+        model = GPT(GPTConfig(**model_args))
+    model.to_empty(device='cpu')
+    load_sharded(model, None, out_dir, iter_num)
+    return model.state_dict()
+
+def save_torch(checkpoint, path):
+    # torch.save, but atomically via a temp file, so a crash mid-write never leaves a broken checkpoint
+    torch.save(checkpoint, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def _snapshot(obj, buffers, seen, path=()):
+    # copy every tensor in obj into the cpu buffer at the same path, (re)allocating it if needed
+    if isinstance(obj, torch.Tensor):
+        key = (obj.untyped_storage().data_ptr(), obj.storage_offset(), tuple(obj.shape), obj.stride(), obj.dtype)
+        if key in seen: # the tied weights: one buffer, so the sharing survives serialization
+            return seen[key]
+        buf = buffers.get(path)
+        if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+            buf = buffers[path] = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+        buf.copy_(obj.detach(), non_blocking=True)
+        seen[key] = buf
+        return buf
+    if isinstance(obj, dict):
+        return {k: _snapshot(v, buffers, seen, path + (k,)) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_snapshot(v, buffers, seen, path + (i,)) for i, v in enumerate(obj))
+    return obj
+
+class AsyncCheckpointer:
+    """
+    Saves checkpoints in the background. save() copies all tensors of a checkpoint into one of
+    num_buffers preallocated (pinned, for cuda) cpu snapshots and returns right away, a thread
+    then serializes the snapshot and writes it to disk. With two buffers a new snapshot can be
+    taken while the previous one is still being written, beyond that save() waits for a free one.
+    Pending writes are flushed by wait(), and at exit.
+    """
+
+    def __init__(self, num_buffers=2):
+        self.free = queue.Queue()
+        for _ in range(num_buffers):
+            self.free.put({})
+        self.jobs = queue.Queue()
+        self.error = None
+        self.last_write_time = None # seconds the last write took in the background
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, checkpoint, write):
+        """ snapshot checkpoint and call write(snapshot) in the background, e.g. write=save_checkpoint """
+        self._raise()
+        buffers = self.free.get() # blocks while all snapshots are still in flight
+        snapshot = _snapshot(checkpoint, buffers, {})
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            # the copies above are asynchronous, the writer waits for them to land before reading
+            event = torch.cuda.Event()
+            event.record()
+        self.jobs.put((snapshot, write, buffers, event))
+
+    def _run(self):
+        while (job := self.jobs.get()) is not None:
+            snapshot, write, buffers, event = job
+            try:
+                if event is not None:
+                    event.synchronize()
+                t0 = time.time()
+                write(snapshot)
+                self.last_write_time = time.time() - t0
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free.put(buffers)
+                self.jobs.task_done()
+        self.jobs.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint in the background failed") from error
+
+    def wait(self):
+        """ block until all pending checkpoints are on disk """
+        self.jobs.join()
+        self._raise()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.jobs.put(None)
+            self.thread.join()
+        self._raise()
+
+def export(model, path, dtype=None, config=None):
+    """ save only the weights of a GPT, optionally cast to dtype, for inference """
+    state_dict = model.state_dict()
+    if dtype is not None:
+        state_dict = {k: v.to(dtype) if v.is_floating_point() else v for k, v in state_dict.items()}
+        # casting breaks the sharing of the tied weights, restore it so they are saved once
+        state_dict['lm_head.weight'] = state_dict['transformer.wte.weight']
+    save({'model': state_dict, 'model_args': model.config.__dict__, 'config': config or {}}, path)
+
+def model_from_state_dict(model_args, state_dict):
+    """
+    Build a GPT directly around the given (e.g. memory-mapped) tensors: the model is created on the
+    meta device, so no memory is allocated or randomly initialized, and the parameters are assigned.
+    """
+    with torch.device('meta'):
+        model = GPT(GPTConfig(**model_args))
+    unwanted_prefix = '_orig_mod.'
+    state_dict = {k.removeprefix(unwanted_prefix): v for k, v in state_dict.items()}
+    model.load_state_dict(state_dict, assign=True)
+    # assign=True gives the two keys of the tied weight separate parameters, tie them again
+    model.transformer.wte.weight = model.lm_head.weight
+    return model
+
+def load_export(path):
+    """ load a model.bin written by export(), returns the model and the checkpoint dict """
+    checkpoint = load(path)
+    return model_from_state_dict(checkpoint['model_args'], checkpoint['model']), checkpoint
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    out_dir = 'out' # directory of the training checkpoint, the export is written to out_dir/model.bin
+    dtype = 'bfloat16' # dtype of the exported weights: 'float32', 'bfloat16' or 'float16'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    # the training checkpoint, in the new format if it is the latest one, else the pickled ckpt.pt
+    t0 = time.time()
+    if is_latest(out_dir):
+        checkpoint = load_checkpoint(out_dir, optimizer=False)
+    else:
+        checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location='cpu')
+    if checkpoint.get('sharded'):
+        checkpoint['model'] = load_sharded_model(out_dir, checkpoint['model_args'], checkpoint['iter_num'])
+    model = model_from_state_dict(checkpoint['model_args'], checkpoint['model'])
+    print(f"loaded the training checkpoint in {time.time() - t0:.2f}s")
+
+    path = os.path.join(out_dir, 'model.bin')
+    config = {k: v for k, v in checkpoint.get('config', {}).items() if k == 'dataset'} # to find meta.pkl
+    export(model, path, getattr(torch, dtype), config)
+    print(f"exported {dtype} weights to {path} ({os.path.getsize(path) / 1e6:.1f}MB)")
+
+    # cold start: what a sampling worker pays to get a model it can run (before moving it to a device)
+    t0 = time.time()
+    model, _ = load_export(path)
+    print(f"loaded the export in {time.time() - t0:.3f}s")
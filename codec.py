@@ -0,0 +1,91 @@
+# fmt: off
+
+"""
+Encoding text into tokens and decoding them back, for a character vocab from a dataset's meta.pkl
+or else a tiktoken BPE (GPT-2 by default). get_codec loads each one only once per process, so
+sampling at every eval or for every request doesn't re-read meta.pkl or rebuild the BPE.
+
+A char vocab goes through NumPy lookup tables both ways, one vectorized operation per call instead
+of a dict lookup per character. A BPE token can be part of a multi-byte UTF-8 character, so text
+can't be streamed by decoding every token on its own: a Detokenizer holds back the bytes of an
+incomplete character until the tokens that complete it arrive.
+"""
+import codecs
+import pickle
+import functools
+
+import numpy as np
+
+class Codec:
+
+    def __init__(self, meta_path=None, encoding='gpt2'):
+        if meta_path:
+            with open(meta_path, 'rb') as f:
+                meta = pickle.load(f)
+            self.vocab_size = meta['vocab_size']
+            # every token is one character, i.e. one code point
+            code_points = np.array([ord(meta['itos'][i]) for i in range(len(meta['itos']))], dtype=np.uint32)
+            self.lut = np.full(int(code_points.max()) + 1, -1, dtype=np.int64) # code point -> token
+            self.lut[code_points] = np.arange(len(code_points))
+            self.code_points = code_points # token -> code point
+            self.enc = None
+        else:
+            import tiktoken
+            self.enc = tiktoken.get_encoding(encoding)
+            self.vocab_size = self.enc.n_vocab
+
+    def encode_array(self, s):
+        """ the tokens of the string s, as an int64 array """
+        if self.enc is not None:
+            return np.array(self.enc.encode(s, allowed_special={""}), dtype=np.int64)
+        cp = np.frombuffer(s.encode('utf-32-le'), dtype=np.uint32)
+        ids = self.lut[np.minimum(cp, len(self.lut) - 1)]
+        if (unknown := (ids < 0) | (cp >= len(self.lut))).any():
+            raise KeyError(s[np.argmax(unknown)]) # like the dict lookup did
+        return ids
+
+    def encode(self, s):
+        return self.encode_array(s).tolist()
+
+    def decode(self, ids):
+        if self.enc is not None:
+            return self.enc.decode(ids)
+        return self.code_points[np.asarray(ids, dtype=np.int64)].tobytes().decode('utf-32-le')
+
+    def decode_bytes(self, ids):
+        if self.enc is not None:
+            return self.enc.decode_bytes(ids)
+        return self.decode(ids).encode('utf-8')
+
+    def token_bytes(self):
+        """ the number of UTF-8 bytes of the text of every token, 0 for special ones like <|endoftext|> """
+        if self.enc is None:
+            return np.array([len(chr(cp).encode('utf-8')) for cp in self.code_points], dtype=np.int64)
+        special = {self.enc.encode_single_token(t) for t in self.enc.special_tokens_set}
+        return np.array([0 if i in special else len(self.enc.decode_single_token_bytes(i))
+                         for i in range(self.enc.n_vocab)], dtype=np.int64)
+
+    def detokenizer(self):
+        return Detokenizer(self)
+
+class Detokenizer:
+    """ decodes a stream of tokens incrementally, the text of every character once it is complete """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.utf8 = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+    def decode(self, ids):
+        """ the text that the tokens ids complete, possibly '' """
+        if self.codec.enc is None:
+            return self.codec.decode(ids) # characters are always complete
+        return self.utf8.decode(self.codec.decode_bytes(ids))
+
+    def flush(self):
+        """ the rest at the end of the stream, a replacement character if it ended inside one """
+        return self.utf8.decode(b'', final=True)
+
+@functools.lru_cache(maxsize=None)
+def get_codec(meta_path=None, encoding='gpt2'):
+    """ the Codec of the dataset with the meta.pkl meta_path, or of the tiktoken encoding if None, cached """
+    return Codec(meta_path, encoding)
@@ -0,0 +1,9 @@
+# a benchmark matrix small enough for a cpu, see benchmark.py
+model = ('tiny', 'baby')
+batch_size = (4, 8)
+block_size = (128,)
+dtype = ('float32', 'bfloat16')
+compile = (False,)
+device = ('cpu',)
+warmup_iters = 3
+iters = 10
@@ -1,16 +1,19 @@
 """
 Prepare the Jane Austen dataset for character-level language modeling.
 So instead of encoding with GPT-2 BPE tokens, we just map characters to ints.
-Will save train.bin, val.bin containing the ids, and meta.pkl containing the
+Will save train.bin, val.bin containing the ids (as uint8, see dataset.py), and meta.pkl containing the
 encoder and decoder and some other related info.
 """
 import os
+import sys
 from io import BytesIO
 from zipfile import ZipFile
 
 import pickle
 import requests
-import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "..", ".."))
+from dataset import write_tokens
 
 # download the jane austen dataset
 input_file_path = os.path.join(os.path.dirname(__file__), "input.txt")
@@ -75,11 +78,9 @@ val_ids = encode(val_data)
 print(f"train has {len(train_ids):,} tokens")
 print(f"val has {len(val_ids):,} tokens")
 
-# export to bin files
-train_ids = np.array(train_ids, dtype=np.uint16)
-val_ids = np.array(val_ids, dtype=np.uint16)
-train_ids.tofile(os.path.join(os.path.dirname(__file__), "train.bin"))
-val_ids.tofile(os.path.join(os.path.dirname(__file__), "val.bin"))
+# export to bin files, in the narrowest dtype for the vocab: uint8
+write_tokens(os.path.join(os.path.dirname(__file__), "train.bin"), train_ids, vocab_size)
+write_tokens(os.path.join(os.path.dirname(__file__), "val.bin"), val_ids, vocab_size)
 
 # save the meta information as well, to help us encode/decode later
 meta = {
@@ -2,10 +2,13 @@
 # https://github.com/HazyResearch/flash-attention/blob/main/training/src/datamodules/language_modeling_hf.py
 
 import os
+import sys
 from tqdm import tqdm
 import numpy as np
 import tiktoken
 from datasets import load_dataset # huggingface datasets
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from dataset import ShardWriter
 
 # number of workers in .map() call
 # good number to use is ~order number of cpu cores // 2
@@ -54,27 +57,24 @@ if __name__ == '__main__':
         num_proc=num_proc,
     )
 
-    # concatenate all the ids in each dataset into one large file we can use for training
+    # write the ids of each split into shards of 100M tokens plus an index, see dataset.py. data added
+    # later (e.g. another run of this script on more documents) just goes into new shards
     for split, dset in tokenized.items():
-        arr_len = np.sum(dset['len'], dtype=np.uint64)
-        filename = os.path.join(os.path.dirname(__file__), f'{split}.bin')
-        dtype = np.uint16 # (can do since enc.max_token_value == 50256 is < 2**16)
-        arr = np.memmap(filename, dtype=dtype, mode='w+', shape=(arr_len,))
+        writer = ShardWriter(os.path.dirname(__file__), split, vocab_size=enc.n_vocab) # uint16, since enc.max_token_value == 50256 is < 2**16
         total_batches = 1024
 
-        idx = 0
-        for batch_idx in tqdm(range(total_batches), desc=f'writing {filename}'):
+        for batch_idx in tqdm(range(total_batches), desc=f'writing {split} shards'):
             # Batch together samples for faster write
             batch = dset.shard(num_shards=total_batches, index=batch_idx, contiguous=True).with_format('numpy')
             arr_batch = np.concatenate(batch['ids'])
-            # Write into mmap
-            arr[idx : idx + len(arr_batch)] = arr_batch
-            idx += len(arr_batch)
-        arr.flush()
+            # every document starts right after the previous one
+            doc_starts = np.concatenate([[0], np.cumsum(batch['len'])[:-1]])
+            writer.write(arr_batch, doc_starts)
+        writer.close()
 
-    # train.bin is ~17GB, val.bin ~8.5MB
+    # train is ~17GB in 91 shards, val ~8.5MB in 1 shard
     # train has ~9B tokens (9,035,582,198)
     # val has ~4M tokens (4,434,897)
 
-    # to read the bin files later, e.g. with numpy:
-    # m = np.memmap('train.bin', dtype=np.uint16, mode='r')
+    # to read the shards later as one array, e.g. with numpy:
+    # from dataset import open_tokens; m = open_tokens('data/openwebtext', 'train')
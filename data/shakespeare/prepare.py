@@ -1,7 +1,9 @@
 import os
+import sys
 import requests
 import tiktoken
-import numpy as np
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+from dataset import write_tokens
 
 # download the tiny shakespeare dataset
 input_file_path = os.path.join(os.path.dirname(__file__), 'input.txt')
@@ -23,11 +25,9 @@ val_ids = enc.encode_ordinary(val_data)
 print(f"train has {len(train_ids):,} tokens")
 print(f"val has {len(val_ids):,} tokens")
 
-# export to bin files
-train_ids = np.array(train_ids, dtype=np.uint16)
-val_ids = np.array(val_ids, dtype=np.uint16)
-train_ids.tofile(os.path.join(os.path.dirname(__file__), 'train.bin'))
-val_ids.tofile(os.path.join(os.path.dirname(__file__), 'val.bin'))
+# export to bin files, in the narrowest dtype for the vocab: uint16
+write_tokens(os.path.join(os.path.dirname(__file__), 'train.bin'), train_ids, enc.n_vocab)
+write_tokens(os.path.join(os.path.dirname(__file__), 'val.bin'), val_ids, enc.n_vocab)
 
 # train.bin has 301,966 tokens
 # val.bin has 36,059 tokens
@@ -0,0 +1,234 @@
+# fmt: off
+
+"""
+Token files and sharded token datasets.
+
+A token file (.bin) starts with a 64 byte header: the magic b'GPTTOKEN', a format version, the
+size of a token in bytes (1, 2 or 4, i.e. uint8, uint16 or uint32), the vocab size and the number
+of tokens. write_tokens picks the narrowest dtype for the vocab, e.g. uint8 for a char vocab,
+and read_tokens memory-maps the tokens after the header in their dtype. Files without a header,
+from before, are read as raw uint16. The tokens are only widened to int64 by the loaders, batch
+by batch.
+
+A sharded split is many such .bin shards of (at most) shard_size tokens, plus a small index
+data/<dataset>/<split>.index.json with the token dtype, the vocab size, and the file, number of
+tokens and number of documents of every shard. The offsets at which documents start within a
+shard are in a .docs.npy next to it. Adding data only writes new shards and rewrites the index,
+nothing else is ever rewritten, and shards can be copied around in parallel.
+
+ShardedTokens memory-maps the shards lazily and presents them as one virtual token array, and
+open_tokens returns one for a split with an index, or else the single <split>.bin as before.
+
+Convert a single-file split into shards (documents are found via the end-of-text token):
+$ python dataset.py --dataset=openwebtext --split=train
+"""
+import os
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'GPTTOKEN'
+VERSION = 1
+HEADER_SIZE = 64
+_header = struct.Struct('<8sIIQQ') # magic, version, bytes per token, vocab size, number of tokens
+
+def token_dtype(vocab_size):
+    """ the narrowest unsigned dtype that holds every token of the vocab """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if vocab_size <= np.iinfo(dtype).max + 1:
+            return np.dtype(dtype)
+    raise ValueError(f"vocab size {vocab_size} is too large")
+
+def write_tokens(path, ids, vocab_size):
+    """ write the tokens ids to a token file, in the narrowest dtype for vocab_size """
+    dtype = token_dtype(vocab_size)
+    ids = np.asarray(ids)
+    assert len(ids) == 0 or ids.max() < vocab_size, f"token {ids.max()} is not in the vocab"
+    with open(path, 'wb') as f:
+        f.write(_header.pack(MAGIC, VERSION, dtype.itemsize, vocab_size, len(ids)).ljust(HEADER_SIZE, b'\0'))
+        ids.astype(dtype, copy=False).tofile(f)
+
+def read_header(path):
+    """ the header of a token file as a dict with dtype, vocab_size and num_tokens, None if it has none """
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if len(header) < HEADER_SIZE or not header.startswith(MAGIC):
+        return None
+    _, version, itemsize, vocab_size, num_tokens = _header.unpack_from(header)
+    assert version == VERSION, f"{path} has version {version} of the token file format"
+    return {'dtype': np.dtype(f'uint{8 * itemsize}'), 'vocab_size': vocab_size, 'num_tokens': num_tokens}
+
+def read_tokens(path):
+    """ the tokens of a token file, memory-mapped in their dtype """
+    if (header := read_header(path)) is None:
+        return np.memmap(path, dtype=np.uint16, mode='r') # raw uint16, written before there were headers
+    if header['num_tokens'] == 0:
+        return np.zeros(0, dtype=header['dtype']) # np.memmap can't map nothing
+    return np.memmap(path, dtype=header['dtype'], mode='r', offset=HEADER_SIZE, shape=(header['num_tokens'],))
+
+def index_path(data_dir, split):
+    return os.path.join(data_dir, f'{split}.index.json')
+
+def open_tokens(data_dir, split):
+    """ the tokens of a split, sharded if it has an index, else the memory-mapped <split>.bin """
+    if os.path.exists(index_path(data_dir, split)):
+        return ShardedTokens(index_path(data_dir, split))
+    return read_tokens(os.path.join(data_dir, f'{split}.bin'))
+
+def exists(data_dir, split):
+    return os.path.exists(index_path(data_dir, split)) or os.path.exists(os.path.join(data_dir, f'{split}.bin'))
+
+class ShardedTokens:
+    """ the shards listed in an index as one read-only token array, supporting len, slicing and gather """
+
+    def __init__(self, path):
+        with open(path) as f:
+            self.index = json.load(f)
+        self.dir = os.path.dirname(path)
+        self.dtype = np.dtype(self.index['dtype'])
+        self.vocab_size = self.index['vocab_size']
+        # where every shard starts in the virtual array, and where the last one ends
+        self.offsets = np.cumsum([0] + [s['num_tokens'] for s in self.index['shards']])
+        self.shards = [None] * len(self.index['shards']) # memory-mapped on first use
+        self.windows = {} # (shard, length) -> the 2D view of all windows of that length, for gather
+
+    def shard(self, i):
+        if self.shards[i] is None:
+            s = self.index['shards'][i]
+            self.shards[i] = read_tokens(os.path.join(self.dir, s['file']))
+            assert len(self.shards[i]) == s['num_tokens'] and self.shards[i].dtype == self.dtype, f"{s['file']} doesn't match the index"
+        return self.shards[i]
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            assert step == 1, "only contiguous slices"
+        else:
+            start, stop = int(key), int(key) + 1
+        parts = []
+        i = np.searchsorted(self.offsets, start, side='right') - 1
+        while start < stop: # a slice can span several shards
+            hi = min(stop, self.offsets[i + 1])
+            parts.append(self.shard(i)[start - self.offsets[i]:hi - self.offsets[i]])
+            start, i = hi, i + 1
+        if not parts: # an empty slice, as a single memmap would return
+            return np.empty(0, dtype=self.dtype)
+        out = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return out if isinstance(key, slice) else out[0]
+
+    def gather(self, ix, length):
+        """ the rows data[i:i+length] for all i in ix as one (len(ix), length) array """
+        out = np.empty((len(ix), length), dtype=self.dtype)
+        first = np.searchsorted(self.offsets, ix, side='right') - 1
+        last = np.searchsorted(self.offsets, ix + length - 1, side='right') - 1
+        for i in np.unique(first):
+            rows = (first == i) & (last == i)
+            if rows.any(): # one vectorized gather per shard
+                if (i, length) not in self.windows:
+                    self.windows[i, length] = np.lib.stride_tricks.sliding_window_view(self.shard(i), length)
+                out[rows] = self.windows[i, length][ix[rows] - self.offsets[i]]
+        for r in np.flatnonzero(first != last): # the few windows that cross into the next shard
+            out[r] = self[ix[r]:ix[r] + length]
+        return out
+
+    def doc_starts(self):
+        """ the offsets of the starts of all documents in the virtual array """
+        starts = [np.load(os.path.join(self.dir, s['docs'])) + self.offsets[i] for i, s in enumerate(self.index['shards'])]
+        return np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+
+class ShardWriter:
+    """
+    Writes tokens of a vocab of vocab_size into shards of shard_size tokens, in the narrowest dtype,
+    appending to the split's existing shards if there are any. The index is updated after every
+    shard, so it always lists complete shards only.
+    """
+
+    def __init__(self, data_dir, split, vocab_size, shard_size=100_000_000):
+        self.data_dir = data_dir
+        self.split = split
+        self.path = index_path(data_dir, split)
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.index = json.load(f)
+            assert self.index['vocab_size'] == vocab_size, f"{self.path} has a vocab of {self.index['vocab_size']} tokens"
+        else:
+            self.index = {'dtype': token_dtype(vocab_size).name, 'vocab_size': vocab_size, 'shards': []}
+        self.buf = np.empty(shard_size, dtype=self.index['dtype'])
+        self.n = 0 # tokens in buf
+        self.docs = [] # document starts in buf
+
+    def write(self, ids, doc_starts=(0,), whole=False):
+        """
+        append the tokens ids, in which documents start at the offsets doc_starts (by default: one
+        document). with whole, ids that don't fit into the current shard start the next one instead
+        of being split across the two, so shards end where a write ended
+        """
+        ids, doc_starts = np.asarray(ids), np.asarray(doc_starts, dtype=np.int64)
+        if whole and self.n + len(ids) > len(self.buf):
+            assert len(ids) <= len(self.buf), "ids don't fit into one shard"
+            self.flush()
+        while len(ids):
+            n = min(len(ids), len(self.buf) - self.n)
+            self.buf[self.n:self.n + n] = ids[:n]
+            self.docs.append(doc_starts[doc_starts < n] + self.n)
+            self.n += n
+            ids, doc_starts = ids[n:], doc_starts[doc_starts >= n] - n
+            if self.n == len(self.buf):
+                self.flush()
+
+    def flush(self):
+        """ write out the tokens so far as a shard, even if it isn't full """
+        if self.n == 0:
+            return
+        name = f'{self.split}_{len(self.index["shards"]):06d}'
+        write_tokens(os.path.join(self.data_dir, name + '.bin'), self.buf[:self.n], self.index['vocab_size'])
+        docs = np.concatenate(self.docs)
+        np.save(os.path.join(self.data_dir, name + '.docs.npy'), docs)
+        self.index['shards'].append({'file': name + '.bin', 'num_tokens': self.n, 'num_docs': len(docs), 'docs': name + '.docs.npy'})
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(self.path + '.tmp', self.path)
+        self.n, self.docs = 0, []
+
+    def close(self):
+        self.flush()
+
+if __name__ == '__main__':
+    import pickle
+    # -----------------------------------------------------------------------------
+    dataset = 'openwebtext'
+    split = 'train'
+    shard_size = 100_000_000 # tokens per shard, 200MB of uint16 for GPT-2
+    eot_token = None # token that ends every document, defaults to GPT-2's <|endoftext|> unless there is a meta.pkl
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    data_dir = os.path.join('data', dataset)
+    assert not os.path.exists(index_path(data_dir, split)), f"{split} is sharded already"
+    data = read_tokens(os.path.join(data_dir, f'{split}.bin'))
+    meta_path = os.path.join(data_dir, 'meta.pkl')
+    if (header := read_header(os.path.join(data_dir, f'{split}.bin'))) is not None:
+        vocab_size = header['vocab_size']
+    elif os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            vocab_size = pickle.load(f)['vocab_size'] # e.g. characters, with no document boundaries
+    else:
+        vocab_size = 50257
+    if eot_token is None and not os.path.exists(meta_path):
+        eot_token = 50256
+
+    writer = ShardWriter(data_dir, split, vocab_size, shard_size)
+    for start in range(0, len(data), shard_size):
+        ids = data[start:start + shard_size]
+        doc_starts = [0] if start == 0 or (eot_token is not None and data[start - 1] == eot_token) else []
+        if eot_token is not None:
+            # a document starts right after every end-of-text token
+            ends = np.flatnonzero(ids == eot_token) + 1
+            doc_starts = np.concatenate([doc_starts, ends[ends < len(ids)]])
+        writer.write(ids, doc_starts)
+        print(f"wrote {start + len(ids):,} / {len(data):,} tokens")
+    writer.close()
+    print(f"{len(writer.index['shards'])} shards and {index_path(data_dir, split)} written, {split}.bin can be deleted now")
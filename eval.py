@@ -0,0 +1,121 @@
+# fmt: off
+
+"""
+Evaluate a model on an entire split, exactly: every token of it (but the first) is predicted once,
+given up to block_size tokens of context. Windows of block_size tokens slide over the split by
+stride tokens, and of every window only the last stride targets are scored, the ones before are
+context only (the first window scores all of its targets). stride = block_size is the cheapest
+but scores many tokens with little context, smaller strides cost block_size / stride times more
+compute for a loss closer to that with full context.
+
+Reports the loss, perplexity, bits per byte (of the text the scored tokens decode to, so models
+with different tokenizers are comparable) and tokens per second. The result is the same at every
+run, for every batch_size and number of processes, so it compares checkpoints and their quantized
+or exported variants exactly:
+$ python eval.py --out_dir=out-shakespeare-char --device=cpu
+$ python eval.py --out_dir=out-shakespeare-char --init_from=int8 --device=cpu
+$ python eval.py config/eval_gpt2.py --stride=512
+
+Sharded across processes, every one of them scoring its share of the windows:
+$ torchrun --standalone --nproc_per_node=8 eval.py --init_from=gpt2-xl
+"""
+import os
+import math
+import time
+from contextlib import nullcontext
+
+import numpy as np
+import torch
+from torch.distributed import init_process_group, destroy_process_group
+
+from sample import load_model
+from codec import get_codec
+from dataset import open_tokens
+from loader import gatherer
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir), 'export' or 'int8' (exported/quantized model in out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is a gpt2 variant
+dataset = 'openwebtext' # used if the model has no dataset of its own, e.g. the gpt2 variants
+split = 'val'
+block_size = 0 # context of every window, 0 = the model's block_size
+stride = 0 # targets scored per window, 0 = block_size // 2
+batch_size = 8 # windows per forward pass
+max_tokens = 0 # only evaluate the first max_tokens tokens of the split, 0 = all of them
+log_interval = 50 # batches
+backend = 'nccl' # 'nccl', 'gloo', etc., when run with torchrun
+device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+compile = False # use PyTorch 2.0 to compile the model to be faster
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+ddp = int(os.environ.get('RANK', -1)) != -1 # is this a distributed run?
+if ddp:
+    init_process_group(backend=backend)
+    rank, world_size = int(os.environ['RANK']), int(os.environ['WORLD_SIZE'])
+    if device.startswith('cuda'):
+        device = f"cuda:{os.environ['LOCAL_RANK']}"
+        torch.cuda.set_device(device)
+else:
+    rank, world_size = 0, 1
+master_process = rank == 0
+torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+model, meta_path = load_model(init_from, out_dir, device)
+if meta_path is not None:
+    dataset = os.path.basename(os.path.dirname(meta_path))
+if compile:
+    model = torch.compile(model) # requires PyTorch 2.0 (optional)
+data = open_tokens(os.path.join('data', dataset), split)
+num_tokens = min(len(data), max_tokens) if max_tokens > 0 else len(data)
+block_size = min(block_size or model.config.block_size, model.config.block_size, num_tokens - 1)
+stride = min(stride or max(block_size // 2, 1), block_size)
+
+# window k predicts the targets up to ends[k], and scores the ones after those of window k - 1
+num_windows = math.ceil(max(num_tokens - 1 - block_size, 0) / stride) + 1
+ends = np.minimum(block_size + stride * np.arange(num_windows), num_tokens - 1)
+scored = np.diff(ends, prepend=0) # the first window scores all of its block_size targets
+# every process scores a contiguous share of the windows
+windows = np.array_split(np.arange(num_windows), world_size)[rank]
+gather = gatherer(data, block_size + 1)
+if master_process:
+    print(f"evaluating {num_tokens - 1:,} tokens of {dataset}/{split} in {num_windows:,} windows of "
+          f"{block_size} tokens, scoring {stride} per window, on {world_size} process(es)")
+
+# summed loss, number of scored tokens and their number of bytes, accumulated on the device in float64
+totals = torch.zeros(3, dtype=torch.float64, device=device)
+bytes_per_token = get_codec(meta_path).token_bytes()
+t0 = time.time()
+with torch.no_grad(), ctx:
+    for i, batch in enumerate(np.array_split(windows, max(math.ceil(len(windows) / batch_size), 1))):
+        if len(batch) == 0:
+            continue # more processes than windows
+        tokens = gather(ends[batch] - block_size) # (b, block_size + 1), the inputs and then the targets
+        context = np.arange(block_size)[None, :] < block_size - scored[batch][:, None] # targets that are not scored
+        num_bytes = np.where(context, 0, bytes_per_token[tokens[:, 1:]]).sum()
+        X = torch.from_numpy(tokens[:, :-1].astype(np.int64)).to(device, non_blocking=True)
+        Y = torch.from_numpy(np.where(context, -1, tokens[:, 1:].astype(np.int64))).to(device, non_blocking=True)
+        _, loss = model(X, Y) # the mean over the scored targets
+        n = int(scored[batch].sum())
+        totals += torch.tensor([0.0, n, num_bytes], dtype=torch.float64).to(device, non_blocking=True)
+        totals[0] += loss.double() * n
+        if master_process and log_interval and i % log_interval == 0:
+            print(f"batch {i}: {totals[1].item():,.0f} tokens scored, loss so far {(totals[0] / totals[1]).item():.4f}")
+if ddp:
+    torch.distributed.all_reduce(totals)
+dt = time.time() - t0
+
+if master_process:
+    loss, count, num_bytes = totals[0].item(), totals[1].item(), totals[2].item()
+    assert count == num_tokens - 1, "every token but the first should have been scored once"
+    print(f"loss {loss / count:.4f}, perplexity {math.exp(loss / count):.4f}, "
+          f"bits per byte {loss / math.log(2) / max(num_bytes, 1):.4f}, "
+          f"{count:,.0f} tokens in {dt:.1f}s ({count / dt:,.0f} tokens/s scored, "
+          f"{len(ends) * block_size / dt:,.0f} tokens/s forwarded)")
+if ddp:
+    destroy_process_group()
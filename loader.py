@@ -0,0 +1,221 @@
+# fmt: off
+
+"""
+A background data loader for the .bin token files. All windows of a batch are gathered from the
+memory-mapped tokens with one vectorized NumPy indexing operation, instead of a Python loop of
+slices and a torch.stack. Worker threads keep a ring of ready batches ahead of the training loop,
+in preallocated (pinned, for cuda) buffers, so taking a batch is just a non-blocking copy to the
+device. wait_time adds up how long the training loop had to wait for data; if it stays ~0, the
+loader keeps up and the device is never starved. Which windows make up a batch is up to a sampler:
+random ones, or a WindowSampler that walks all of the data once per epoch, resumably.
+
+Run this file for a microbenchmark against the original get_batch:
+$ python loader.py --dataset=shakespeare_char --device=cpu
+"""
+import time
+import queue
+import threading
+
+import numpy as np
+import torch
+
+def gatherer(data, length):
+    """ a function that gathers the rows data[i:i+length] for all i in ix, gatherer(data, length)(ix) """
+    if hasattr(data, 'gather'): # e.g. the virtual token array of a sharded dataset
+        return lambda ix: data.gather(ix, length)
+    # every window of length tokens as rows of a 2D view, nothing is read or copied here
+    windows = np.lib.stride_tricks.sliding_window_view(data, length)
+    return lambda ix: windows[ix]
+
+def fixed_windows(data, block_size, num_windows, rank=0, world_size=1):
+    """
+    num_windows windows of block_size + 1 tokens, spread evenly over all of data and the same ones
+    every time, split into world_size equal parts: part rank as one (n, block_size + 1) int64 tensor.
+    num_windows is rounded down to a multiple of world_size, so every rank runs the same number of
+    forwards over its part (under FSDP each one is a collective, and an extra one would hang)
+    """
+    num_windows = max(world_size, num_windows - num_windows % world_size)
+    ix = np.linspace(0, len(data) - block_size - 1, num_windows).astype(np.int64)
+    ix = ix.reshape(world_size, -1)[rank]
+    return torch.from_numpy(gatherer(data, block_size + 1)(ix).astype(np.int64))
+
+def random_windows(num_tokens, block_size, batch_size, seed):
+    """ batch k starts at batch_size uniformly random offsets, the same ones for the same (seed, k) """
+    def sample(k):
+        return np.random.default_rng([seed, k]).integers(num_tokens - block_size, size=batch_size)
+    return sample
+
+class WindowSampler:
+    """
+    Walks a seeded random permutation of the non-overlapping windows of the data, epoch after epoch
+    with a new permutation each, so every token is trained on once per epoch. Every global batch of
+    world_size * batch_size windows is split between the ranks, so they never see the same window.
+    The position in the walk is saved with state_dict() and restored with load_state_dict(), also
+    with a different number of ranks or batch_size, so a resumed run continues where it stopped.
+    """
+
+    def __init__(self, num_tokens, block_size, batch_size, seed=1337, rank=0, world_size=1):
+        self.num_windows = (num_tokens - 1) // block_size # the targets need one more token
+        self.block_size = block_size
+        self.batch_size = batch_size
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.start = 0 # the position of batch 0 in the walk, in windows
+        self.perms = {} # the permutations of the current and the next epoch
+        self.lock = threading.Lock() # shared by the loader threads
+
+    def _perm(self, epoch):
+        with self.lock:
+            if epoch not in self.perms:
+                if len(self.perms) == 2:
+                    del self.perms[min(self.perms)]
+                self.perms[epoch] = np.random.default_rng([self.seed, epoch]).permutation(self.num_windows)
+            return self.perms[epoch]
+
+    def __call__(self, k):
+        """ the start offsets of the windows of batch k of this rank """
+        pos = self.start + (k * self.world_size + self.rank) * self.batch_size + np.arange(self.batch_size)
+        epoch, i = np.divmod(pos, self.num_windows)
+        ix = np.empty(self.batch_size, dtype=np.int64)
+        for e in np.unique(epoch): # a batch can straddle two epochs
+            ix[epoch == e] = self._perm(e)[i[epoch == e]]
+        return ix * self.block_size
+
+    def state_dict(self, k):
+        """ the position in the walk after the first k batches of every rank """
+        return {'seed': self.seed, 'num_windows': self.num_windows,
+                'position': self.start + k * self.world_size * self.batch_size}
+
+    def load_state_dict(self, state):
+        assert state['num_windows'] == self.num_windows, "the data changed, can't continue where training stopped"
+        self.seed = state['seed']
+        self.start = state['position']
+
+class BatchLoader:
+    """
+    Iterates over (x, y) batches of batch_size windows of block_size tokens of data, already on
+    device. sample(k) gives the start offsets of the windows of batch k, random by default. Batch k
+    is gathered by worker k % num_workers, and every worker keeps up to prefetch batches ready.
+    Batches are handed out in order, starting with batch number start.
+    """
+
+    def __init__(self, data, block_size, batch_size, device, sample=None, seed=1337, num_workers=1, prefetch=4, start=0):
+        self.device = torch.device(device)
+        self.gather = gatherer(data, block_size + 1)
+        self.sample = sample or random_windows(len(data), block_size, batch_size, seed)
+        self.num_workers = num_workers
+        self.k = start # the number of the next batch to hand out
+        self.wait_time = 0.0 # seconds spent waiting for a batch in __next__
+        pin = self.device.type == 'cuda'
+        self.free = [queue.Queue() for _ in range(num_workers)]
+        self.ready = [queue.Queue() for _ in range(num_workers)]
+        for free in self.free:
+            for _ in range(prefetch):
+                x = torch.empty((batch_size, block_size), dtype=torch.int64, pin_memory=pin)
+                y = torch.empty((batch_size, block_size), dtype=torch.int64, pin_memory=pin)
+                free.put((x, y, None))
+        self.threads = [threading.Thread(target=self._run, args=(i,), daemon=True) for i in range(num_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, i):
+        k = self.k + (i - self.k) % self.num_workers # the first batch of this worker
+        while (buffers := self.free[i].get()) is not None:
+            x, y, event = buffers
+            try:
+                if event is not None:
+                    event.synchronize() # the last copy out of these buffers has to be done first
+                batch = self.gather(self.sample(k)) # (batch_size, block_size + 1), in one go
+                x.numpy()[:] = batch[:, :-1]
+                y.numpy()[:] = batch[:, 1:]
+            except Exception as e:
+                self.ready[i].put(e)
+                return
+            self.ready[i].put((x, y))
+            k += self.num_workers
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        i = self.k % self.num_workers
+        t0 = time.time()
+        batch = self.ready[i].get()
+        self.wait_time += time.time() - t0
+        if isinstance(batch, Exception):
+            raise RuntimeError(f"loading batch {self.k} failed") from batch
+        self.k += 1
+        x, y = batch
+        event = None
+        if self.device.type == 'cuda':
+            # asynchronous copy out of the pinned buffers, the worker waits for it before refilling them
+            x_device, y_device = x.to(self.device, non_blocking=True), y.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            # the batch is still used by backward while the next one is loaded, so don't hand out the buffers
+            x_device, y_device = x.to(self.device, copy=True), y.to(self.device, copy=True)
+        self.free[i].put((x, y, event))
+        return x_device, y_device
+
+    def close(self):
+        for free in self.free:
+            free.put(None)
+
+if __name__ == '__main__':
+    import os
+    from dataset import open_tokens
+    # -----------------------------------------------------------------------------
+    dataset = 'openwebtext'
+    batch_size = 12
+    block_size = 1024
+    num_workers = 1
+    device = 'cuda'
+    num_batches = 200
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    data = open_tokens(os.path.join('data', dataset), 'train')
+    sync = torch.cuda.synchronize if 'cuda' in device else lambda: None
+
+    # the original get_batch of train.py
+    def get_batch():
+        ix = torch.randint(len(data) - block_size, (batch_size,))
+        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
+        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+        if 'cuda' in device:
+            x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
+        else:
+            x, y = x.to(device), y.to(device)
+        return x, y
+
+    t0 = time.time()
+    for _ in range(num_batches):
+        x, y = get_batch()
+    sync()
+    dt_old = (time.time() - t0) / num_batches
+    print(f"get_batch: {dt_old*1e3:.3f}ms per batch")
+
+    # the same gather, on the calling thread
+    loader = BatchLoader(data, block_size, batch_size, device, num_workers=num_workers)
+    sample = loader.sample
+    t0 = time.time()
+    for k in range(num_batches):
+        batch = torch.from_numpy(loader.gather(sample(k)).astype(np.int64)).to(device)
+        x, y = batch[:, :-1], batch[:, 1:]
+    sync()
+    dt_gather = (time.time() - t0) / num_batches
+    print(f"vectorized gather: {dt_gather*1e3:.3f}ms per batch ({dt_old/dt_gather:.1f}x)")
+
+    # the loader, with a fake 2ms training step per batch for the workers to hide behind
+    time.sleep(0.5) # let the workers fill their rings
+    loader.wait_time = 0.0
+    t0 = time.time()
+    for _ in range(num_batches):
+        x, y = next(loader)
+        time.sleep(0.002)
+    sync()
+    dt = (time.time() - t0) / num_batches - 0.002
+    print(f"BatchLoader: {dt*1e3:.3f}ms per batch on the training thread, "
+          f"waited {loader.wait_time*1e3:.1f}ms for data in total")
+    loader.close()
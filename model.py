@@ -9,13 +9,18 @@ https://github.com/openai/gpt-2/blob/master/src/model.py
 https://github.com/huggingface/transformers/blob/main/src/transformers/models/gpt2/modeling_gpt2.py
 """
 
+import os
 import math
 import inspect
+from collections import OrderedDict
 from dataclasses import dataclass
 
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
+
+from sampler import sample
 
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False """
@@ -51,7 +56,7 @@ class CausalSelfAttention(nn.Module):
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, kv_cache=None, layer=0):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -61,7 +66,17 @@ class CausalSelfAttention(nn.Module):
         v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
-        if self.flash:
+        if kv_cache is not None:
+            # incremental decoding: attend over everything cached so far plus the new positions
+            k, v = kv_cache.update(layer, k, v) # (B, nh, L, hs)
+            if self.flash:
+                y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=kv_cache.mask)
+            else:
+                att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
+                att = att.masked_fill(~kv_cache.mask, float('-inf'))
+                att = F.softmax(att, dim=-1)
+                y = att @ v
+        elif self.flash:
             # efficient attention using Flash Attention CUDA kernels
             y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
         else:
@@ -102,11 +117,196 @@ class Block(nn.Module):
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
 
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+    def forward(self, x, kv_cache=None, layer=0, checkpoint_attn=False):
+        if checkpoint_attn:
+            # don't keep the activations of ln_1 + attention for backward, recompute them instead
+            x = x + checkpoint(lambda x: self.attn(self.ln_1(x)), x, use_reentrant=False)
+        else:
+            x = x + self.attn(self.ln_1(x), kv_cache, layer)
         x = x + self.mlp(self.ln_2(x))
         return x
 
+class KVCache:
+    """
+    Preallocated per-layer key/value buffers for incremental decoding. Each row of the
+    batch tracks its own fill level in `pos`, so rows may hold sequences of different length.
+    """
+
+    def __init__(self, config, batch_size, device=None, dtype=None):
+        self.max_len = config.block_size
+        shape = (batch_size, config.n_head, config.block_size, config.n_embd // config.n_head)
+        self.k = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.v = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(config.n_layer)]
+        self.pos = torch.zeros(batch_size, dtype=torch.long, device=device) # cached length of each row
+        self.length = 0 # max of pos, kept on the host so that we never have to sync on it
+
+    def prepare(self, t):
+        # positions of the t incoming tokens of each row, and which cached keys each may attend to
+        assert self.length + t <= self.max_len, f"KV cache overflow: {self.length + t} > {self.max_len}"
+        device = self.pos.device
+        self.positions = self.pos[:, None] + torch.arange(t, device=device) # (b, t)
+        keys = torch.arange(self.length + t, device=device)
+        self.mask = (keys[None, None, :] <= self.positions[:, :, None])[:, None] # (b, 1, t, L)
+        return self.positions
+
+    def update(self, layer, k, v):
+        # write the new keys/values into their slots and return the filled part of the buffers
+        rows = torch.arange(k.size(0), device=k.device)[:, None]
+        self.k[layer][rows, :, self.positions] = k.transpose(1, 2).to(self.k[layer].dtype)
+        self.v[layer][rows, :, self.positions] = v.transpose(1, 2).to(self.v[layer].dtype)
+        L = self.length + k.size(2)
+        return self.k[layer][:, :, :L], self.v[layer][:, :, :L]
+
+    def advance(self, t):
+        self.pos += t
+        self.length += t
+
+    def select(self, rows):
+        # keep (or repeat) only the given batch rows, e.g. to drop finished sequences
+        self.k = [k[rows] for k in self.k]
+        self.v = [v[rows] for v in self.v]
+        self.pos = self.pos[rows]
+        self.length = int(self.pos.max()) if len(self.pos) else 0
+
+    def extend(self, other):
+        # append the rows of another cache, e.g. to add freshly prefilled sequences to a running batch
+        self.k = [torch.cat((a, b)) for a, b in zip(self.k, other.k)]
+        self.v = [torch.cat((a, b)) for a, b in zip(self.v, other.v)]
+        self.pos = torch.cat((self.pos, other.pos))
+        self.length = max(self.length, other.length)
+
+    def crop(self, length):
+        # forget everything from position length on, e.g. rejected speculative tokens
+        self.pos = self.pos.clamp(max=length)
+        self.length = min(self.length, length)
+
+class PrefixCache:
+    """
+    Keys/values of prompt prefixes shared across requests, so that a common preamble only runs
+    through the model once. Prompts are split into blocks of block_len tokens, each keyed by its own
+    tokens together with the key of the block before it (the tokens themselves rather than a hash of
+    them, so that colliding prefixes can't share keys/values), and the longest run of cached leading
+    blocks is reused. Least recently used blocks are evicted beyond max_bytes.
+    """
+
+    def __init__(self, max_bytes, block_len=16):
+        self.max_bytes = max_bytes
+        self.block_len = block_len
+        self.blocks = OrderedDict() # key -> (k, v), each of shape (n_layer, nh, block_len, hs)
+        self.bytes = 0
+        self.hits = 0 # lookups that reused at least one block
+        self.misses = 0
+        self.hit_tokens = 0 # total number of prompt tokens that did not have to be recomputed
+        self.evictions = 0
+
+    def _keys(self, tokens, n_blocks):
+        keys, key = [], None
+        for i in range(n_blocks):
+            key = (key, tuple(tokens[i*self.block_len:(i+1)*self.block_len]))
+            keys.append(key)
+        return keys
+
+    def _touch(self, keys):
+        # deepest block first, so that a prefix is always more recently used than its extensions
+        for key in reversed(keys):
+            self.blocks.move_to_end(key)
+
+    def lookup(self, tokens):
+        # longest cached prefix of tokens, always leaving at least one token to be forwarded
+        hit = []
+        for key in self._keys(tokens, (len(tokens) - 1) // self.block_len):
+            if key not in self.blocks:
+                break
+            hit.append(key)
+        self._touch(hit)
+        if not hit:
+            self.misses += 1
+            return 0, None, None
+        n = len(hit) * self.block_len
+        self.hits += 1
+        self.hit_tokens += n
+        k = torch.cat([self.blocks[key][0] for key in hit], dim=2) # (n_layer, nh, n, hs)
+        v = torch.cat([self.blocks[key][1] for key in hit], dim=2)
+        return n, k, v
+
+    def insert(self, tokens, kv_cache, row=0):
+        # store all full blocks of tokens, whose keys/values are in the given row of kv_cache
+        keys = self._keys(tokens, len(tokens) // self.block_len)
+        for i, key in enumerate(keys):
+            if key not in self.blocks:
+                s = slice(i * self.block_len, (i + 1) * self.block_len)
+                k = torch.stack([k[row, :, s] for k in kv_cache.k])
+                v = torch.stack([v[row, :, s] for v in kv_cache.v])
+                self.blocks[key] = (k, v)
+                self.bytes += 2 * k.numel() * k.element_size()
+        self._touch(keys)
+        while self.bytes > self.max_bytes and self.blocks:
+            _, (k, v) = self.blocks.popitem(last=False)
+            self.bytes -= 2 * k.numel() * k.element_size()
+            self.evictions += 1
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, hit_tokens=self.hit_tokens,
+                    evictions=self.evictions, blocks=len(self.blocks), bytes=self.bytes)
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Mean cross-entropy of the logits x @ weight.T (N, vocab_size) against targets (N,), ignoring
+    targets of -1, computed chunk_size rows at a time so the full logits never exist in memory.
+    The gradients are computed in the same pass over the chunks, the backward only rescales them.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size, compute_grad):
+        valid = targets != -1
+        n = valid.sum().clamp(min=1)
+        loss = torch.zeros((), dtype=torch.float32, device=x.device)
+        if compute_grad:
+            grad_x = torch.zeros_like(x)
+            grad_w = torch.zeros_like(weight, dtype=torch.float32) # accumulated over the chunks in fp32
+        for i in range(0, x.size(0), chunk_size):
+            x_c, v_c = x[i:i+chunk_size], valid[i:i+chunk_size]
+            t_c = targets[i:i+chunk_size].clamp(min=0)
+            logits = x_c @ weight.t() # (chunk_size, vocab_size), in the autocast dtype if enabled
+            mm_dtype = logits.dtype
+            logits = logits.float()
+            lse = torch.logsumexp(logits, dim=-1)
+            loss += ((lse - logits.gather(1, t_c[:, None])[:, 0]) * v_c).sum()
+            if compute_grad:
+                # d loss / d logits = (softmax(logits) - onehot(targets)) / n, the 1/n is applied at the
+                # end, so that the matmuls below don't lose the small values in reduced precision
+                g = logits.sub_(lse[:, None]).exp_() # in place, the logits aren't needed anymore
+                g[torch.arange(g.size(0), device=g.device), t_c] -= 1
+                g = (g * v_c[:, None]).to(mm_dtype)
+                grad_x[i:i+chunk_size] = g @ weight
+                grad_w += g.t() @ x_c
+        loss = loss / n
+        if compute_grad:
+            ctx.save_for_backward(grad_x.div_(n), grad_w.div_(n).to(weight.dtype))
+        return loss
+
+    @staticmethod
+    def backward(ctx, grad_loss):
+        grad_x, grad_w = ctx.saved_tensors
+        return grad_x * grad_loss, grad_w * grad_loss, None, None, None
+
+def pretrained_source(model_type):
+    """
+    Identify the GPT-2 weights in the local huggingface cache without importing transformers: the
+    resolved path includes the revision hash, size and mtime catch files replaced in place. None if
+    they can't be found, e.g. because the huggingface cache was cleared.
+    """
+    try:
+        from huggingface_hub import try_to_load_from_cache
+    except ImportError:
+        return None
+    for filename in ('model.safetensors', 'pytorch_model.bin'):
+        path = try_to_load_from_cache(model_type, filename)
+        if isinstance(path, str):
+            stat = os.stat(path)
+            return f"{os.path.realpath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    return None
+
 @dataclass
 class GPTConfig:
     block_size: int = 1024
@@ -116,6 +316,9 @@ class GPTConfig:
     n_embd: int = 768
     dropout: float = 0.0
     bias: bool = True # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
+    loss_chunk_size: int = 0 # if > 0, compute lm_head + loss over chunks of this many tokens, without the full logits
+    activation_checkpoint: str = '' # recompute activations in backward instead of storing them: '' off, 'block' or 'attn'
+    activation_checkpoint_every: int = 1 # only checkpoint every k-th Block
 
 class GPT(nn.Module):
 
@@ -169,27 +372,51 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, all_logits=False):
         device = idx.device
         b, t = idx.size()
         assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        if kv_cache is None:
+            pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        else:
+            pos = kv_cache.prepare(t) # shape (b, t), continuing after the cached positions
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd) or (b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        # activation checkpointing trades memory for compute, it only pays off when training
+        mode = self.config.activation_checkpoint if torch.is_grad_enabled() and kv_cache is None else ''
+        assert mode in ('', 'block', 'attn'), f"unknown activation_checkpoint mode {mode}"
+        for i, block in enumerate(self.transformer.h):
+            if mode and i % self.config.activation_checkpoint_every == 0:
+                if mode == 'block':
+                    # keep only the input of the Block, and run its forward again in backward
+                    x = checkpoint(block, x, use_reentrant=False)
+                else:
+                    x = block(x, checkpoint_attn=True)
+            else:
+                x = block(x, kv_cache, i)
         x = self.transformer.ln_f(x)
-
-        if targets is not None:
+        if kv_cache is not None:
+            kv_cache.advance(t)
+
+        if targets is not None and self.config.loss_chunk_size > 0 and isinstance(self.lm_head, nn.Linear):
+            # memory-saving loss: the (b, t, vocab_size) logits are never materialized, so none are returned
+            # (a swapped-in lm_head, e.g. the int8 one of quantize.py, takes the plain path below)
+            x = x.view(-1, x.size(-1))
+            weight = self.lm_head.weight
+            compute_grad = torch.is_grad_enabled() and (x.requires_grad or weight.requires_grad)
+            loss = ChunkedCrossEntropy.apply(x, weight, targets.view(-1), self.config.loss_chunk_size, compute_grad)
+            logits = None
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
             loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
         else:
-            # inference-time mini-optimization: only forward the lm_head on the very last position
-            logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
+            # inference-time mini-optimization: only forward the lm_head on the very last position,
+            # unless the logits of every position are asked for (e.g. to verify speculative tokens)
+            logits = self.lm_head(x if all_logits else x[:, [-1], :]) # note: using list [-1] to preserve the time dim
             loss = None
 
         return logits, loss
@@ -206,12 +433,18 @@ class GPT(nn.Module):
                 block.attn.bias = block.attn.bias[:,:,:block_size,:block_size]
 
     @classmethod
-    def from_pretrained(cls, model_type, override_args=None):
+    def from_pretrained(cls, model_type, override_args=None, cache_dir=None):
+        """
+        Load the OpenAI GPT-2 weights. The first time, they come from huggingface/transformers and
+        the converted state dict is cached in cache_dir (default ~/.cache/nanogpt). Later calls
+        memory-map the cache and skip transformers entirely, unless the source weights changed.
+        """
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
         override_args = override_args or {} # default to empty dict
-        # only dropout can be overridden see more notes below
-        assert all(k == 'dropout' for k in override_args)
-        from transformers import GPT2LMHeadModel
+        # only dropout and the memory-saving settings can be overridden see more notes below
+        assert all(k in ('dropout', 'loss_chunk_size', 'activation_checkpoint', 'activation_checkpoint_every')
+                   for k in override_args)
+        import ckpt # the checkpoint format, imported here because ckpt itself imports this module
         print("loading weights from pretrained gpt: %s" % model_type)
 
         # n_layer, n_head and n_embd are determined from model_type
@@ -225,22 +458,34 @@ class GPT(nn.Module):
         config_args['vocab_size'] = 50257 # always 50257 for GPT model checkpoints
         config_args['block_size'] = 1024 # always 1024 for GPT model checkpoints
         config_args['bias'] = True # always True for GPT model checkpoints
-        # we can override the dropout rate, if desired
-        if 'dropout' in override_args:
-            print(f"overriding dropout rate to {override_args['dropout']}")
-            config_args['dropout'] = override_args['dropout']
-        # create a from-scratch initialized minGPT model
-        config = GPTConfig(**config_args)
-        model = GPT(config)
-        sd = model.state_dict()
+        # we can override the dropout rate and the memory-saving settings, if desired
+        for k, v in override_args.items():
+            print(f"overriding {k} to {v}")
+            config_args[k] = v
+
+        # use the converted weights from an earlier call, if the source weights are still the same
+        cache_dir = cache_dir or os.path.join(os.path.expanduser('~'), '.cache', 'nanogpt')
+        cache_path = os.path.join(cache_dir, f'{model_type}.bin')
+        source = pretrained_source(model_type)
+        if os.path.exists(cache_path):
+            cached = ckpt.load(cache_path)
+            if source is None or cached['source'] == source:
+                print(f"using the converted weights cached in {cache_path}")
+                return ckpt.model_from_state_dict(config_args, cached['model'])
+            print(f"the source weights of {model_type} changed, converting them again")
+
+        # the keys and shapes of our model, from a model on the meta device that takes no memory
+        with torch.device('meta'):
+            sd = GPT(GPTConfig(**config_args)).state_dict()
         sd_keys = sd.keys()
         sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer, not a param
 
         # init a huggingface/transformers model
+        from transformers import GPT2LMHeadModel
         model_hf = GPT2LMHeadModel.from_pretrained(model_type)
         sd_hf = model_hf.state_dict()
 
-        # copy while ensuring all of the parameters are aligned and match in names and shapes
+        # convert while ensuring all of the parameters are aligned and match in names and shapes
         sd_keys_hf = sd_hf.keys()
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.masked_bias')] # ignore these, just a buffer
         sd_keys_hf = [k for k in sd_keys_hf if not k.endswith('.attn.bias')] # same, just the mask (buffer)
@@ -248,21 +493,27 @@ class GPT(nn.Module):
         # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
         # this means that we have to transpose these weights when we import them
         assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
+        converted = {}
         for k in sd_keys_hf:
             if any(k.endswith(w) for w in transposed):
                 # special treatment for the Conv1D weights we need to transpose
                 assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
+                converted[k] = sd_hf[k].t().contiguous()
             else:
                 # vanilla copy over the other parameters
                 assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
-
-        return model
-
-    def configure_optimizers(self, weight_decay, learning_rate, betas, device_type):
+                converted[k] = sd_hf[k]
+        converted['lm_head.weight'] = converted['transformer.wte.weight'] # tied, stored once
+        del model_hf, sd_hf
+
+        # save the converted weights and load them back memory-mapped, so that only one copy stays around
+        os.makedirs(cache_dir, exist_ok=True)
+        ckpt.save({'model': converted, 'source': pretrained_source(model_type)}, cache_path)
+        del converted
+        print(f"cached the converted weights in {cache_path}")
+        return ckpt.model_from_state_dict(config_args, ckpt.load(cache_path)['model'])
+
+    def configure_optimizers(self, weight_decay, learning_rate, betas, device_type, zero=False):
         # start with all of the candidate parameters
         param_dict = {pn: p for pn, p in self.named_parameters()}
         # filter out those that do not require grad
@@ -283,7 +534,14 @@ class GPT(nn.Module):
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         use_fused = fused_available and device_type == 'cuda'
         extra_args = dict(fused=True) if use_fused else dict()
-        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
+        if zero:
+            # ZeRO stage 1: every rank only keeps (and updates) the AdamW state of its own share of the
+            # parameters, and broadcasts the updated parameters to the other ranks after each step
+            from torch.distributed.optim import ZeroRedundancyOptimizer
+            optimizer = ZeroRedundancyOptimizer(optim_groups, optimizer_class=torch.optim.AdamW,
+                                                lr=learning_rate, betas=betas, **extra_args)
+        else:
+            optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
         print(f"using fused AdamW: {use_fused}")
 
         return optimizer
@@ -305,28 +563,265 @@ class GPT(nn.Module):
         return mfu
 
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, prefix_cache=None,
+                 rolling_stride=1, top_p=None, repetition_penalty=None):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_kv_cache=True, keys/values are cached so each step only forwards the newest token,
+        for as long as the sequence fits into block_size. A PrefixCache can be passed to reuse the
+        keys/values of prompt prefixes seen in earlier calls.
+        Past block_size the context has to slide, and with learned absolute position embeddings the
+        cached keys can't simply be shifted. With rolling_stride=1 every step re-encodes the last
+        block_size tokens from scratch (exact, but a full forward pass per token). With a larger
+        rolling_stride the cache is rebuilt from the last block_size - rolling_stride + 1 tokens only
+        once every rolling_stride tokens, and the tokens in between are decoded incrementally. This
+        bounds the cost per token at about 1/rolling_stride of a full forward pass, at the price of
+        conditioning on between block_size - rolling_stride + 1 and block_size tokens instead of
+        always block_size. Memory stays bounded by block_size either way.
+        Sampling can be further restricted with top_p (nucleus sampling), and repetition_penalty
+        discourages the tokens of the last block_size tokens of the sequence, see sampler.sample.
         """
-        for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
-            # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+        assert 1 <= rolling_stride <= self.config.block_size
+        b, t = idx.size()
+        block_size = self.config.block_size
+        # preallocate the whole output instead of growing idx with torch.cat every step
+        tokens = torch.empty((b, t + max_new_tokens), dtype=idx.dtype, device=idx.device)
+        tokens[:, :t] = idx
+        kv_cache = None
+        for n in range(t, t + max_new_tokens):
+            if use_kv_cache and (n <= block_size or rolling_stride > 1):
+                if kv_cache is not None and kv_cache.length < block_size:
+                    # decode: only forward the token sampled in the previous step
+                    logits, _ = self(tokens[:, n-1:n], kv_cache=kv_cache)
+                elif kv_cache is None and n <= block_size and prefix_cache is not None:
+                    # prefill, starting after the longest prefix of the prompt computed in earlier calls
+                    logits, kv_cache = self.prefill(tokens[:, :n].tolist(), prefix_cache)
+                else:
+                    # prefill: run the prompt once and cache its keys/values. Once the cache is full it is
+                    # rebuilt from the end of the sequence, leaving room for rolling_stride - 1 more tokens
+                    context = n if n <= block_size else block_size - rolling_stride + 1
+                    kv_cache = KVCache(self.config, b, device=idx.device, dtype=self.transformer.wpe.weight.dtype)
+                    logits, _ = self(tokens[:, n-context:n], kv_cache=kv_cache)
+            else:
+                # if the sequence context is growing too long we must crop it at block_size
+                idx_cond = tokens[:, max(0, n - block_size):n]
+                # forward the model to get the logits for the index in the sequence
+                logits, _ = self(idx_cond)
+            prev = tokens[:, max(0, n - block_size):n] if repetition_penalty is not None else None
+            idx_next = self.sample_next(logits, temperature, top_k, top_p, repetition_penalty, prev)
             # append sampled index to the running sequence and continue
-            idx = torch.cat((idx, idx_next), dim=1)
+            tokens[:, n] = idx_next[:, 0]
             # yield the last token
             yield idx_next[0].item()
+
+    def _probs(self, logits, temperature, top_k):
+        if temperature == 0:
+            # greedy, as in sample(): all of the probability on the argmax, so that speculative
+            # decoding accepts a proposal exactly if it matches, and resamples to the argmax otherwise
+            return F.one_hot(logits.argmax(dim=-1), logits.size(-1)).to(logits.dtype)
+        # scale by desired temperature
+        logits = logits / temperature
+        # optionally crop the logits to only the top k options
+        if top_k is not None:
+            v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+            logits[logits < v[..., [-1]]] = -float('Inf')
+        # apply softmax to convert logits to (normalized) probabilities
+        return F.softmax(logits, dim=-1)
+
+    def sample_next(self, logits, temperature, top_k, top_p=None, repetition_penalty=None, prev=None):
+        """
+        Sample the next token of every row from the logits (b, t, vocab_size) at the final step, as
+        a (b, 1) LongTensor. The settings are one value or one per row, see sampler.sample. Together
+        with prefill and a forward with kv_cache, this is one step of the decode loop of generate_batch,
+        for callers that run their own loop (e.g. serve.py, which adds and drops rows between steps).
+        """
+        return sample(logits[:, -1, :], temperature, top_k, top_p, repetition_penalty, prev)
+
+    def prefill(self, rows, prefix_cache=None):
+        """
+        Build a fresh KVCache for a list of (ragged, non-empty) token lists, and return the logits
+        (len(rows), 1, vocab_size) at the end of each row together with the cache. Rows of a cache can
+        later be dropped with KVCache.select or appended with KVCache.extend. An optional PrefixCache
+        reuses the keys/values of prompt prefixes.
+        """
+        device = self.lm_head.weight.device
+        if prefix_cache is not None:
+            # rows start at different cached offsets, so they are prefilled one at a time
+            kv_cache, logits = None, []
+            for r in rows:
+                n, k, v = prefix_cache.lookup(r)
+                row_cache = KVCache(self.config, 1, device=device, dtype=self.transformer.wpe.weight.dtype)
+                if n > 0:
+                    for layer in range(self.config.n_layer):
+                        row_cache.k[layer][0, :, :n] = k[layer]
+                        row_cache.v[layer][0, :, :n] = v[layer]
+                    row_cache.advance(n)
+                row_logits, _ = self(torch.tensor([r[n:]], dtype=torch.long, device=device), kv_cache=row_cache)
+                prefix_cache.insert(r, row_cache)
+                logits.append(row_logits)
+                if kv_cache is None:
+                    kv_cache = row_cache
+                else:
+                    kv_cache.extend(row_cache)
+            return torch.cat(logits), kv_cache
+        lengths = torch.tensor([len(r) for r in rows], device=device)
+        T = max(len(r) for r in rows)
+        padded = torch.zeros((len(rows), T), dtype=torch.long)
+        for i, r in enumerate(rows):
+            padded[i, :len(r)] = torch.tensor(r, dtype=torch.long)
+        padded = padded.to(device)
+        kv_cache = KVCache(self.config, len(rows), device=device, dtype=self.transformer.wpe.weight.dtype)
+        if T > 1:
+            self(padded[:, :T-1], kv_cache=kv_cache)
+        # rewind every row to just before its last token and forward that token again: this
+        # overwrites the padding garbage of shorter rows and gives us the logits at each row's end
+        kv_cache.pos = lengths - 1
+        logits, _ = self(padded.gather(1, kv_cache.pos[:, None]), kv_cache=kv_cache)
+        return logits, kv_cache
+
+    @torch.no_grad()
+    def generate_batch(self, prompts, max_new_tokens, temperature=1.0, top_k=None, num_samples=1,
+                       stop_tokens=None, stop_fn=None, prefix_cache=None, rolling_stride=1,
+                       top_p=None, repetition_penalty=None):
+        """
+        Batched generation for a list of prompts (lists of token ids, possibly of different lengths),
+        each sampled num_samples times. All rows are decoded together through one KV cache. A row
+        finishes when it samples a token in stop_tokens (a set of ids, or one set per returned row),
+        when stop_fn(row, new_tokens) returns True, or after max_new_tokens; finished rows are dropped
+        from the active batch. Returns the list of new tokens of every row, in the order
+        [prompt 0 sample 0, prompt 0 sample 1, ..., prompt 1 sample 0, ...]. An optional PrefixCache
+        reuses the keys/values of prompt prefixes across calls. Past block_size, rolling_stride trades
+        context length for speed as in generate(). The sampling settings temperature, top_k, top_p and
+        repetition_penalty are either one value for all rows or a list of one value per returned row.
+        """
+        block_size = self.config.block_size
+        device = self.lm_head.weight.device
+        b = len(prompts) * num_samples
+        assert all(len(p) > 0 for p in prompts), "every prompt needs at least one token, e.g. start an empty one from a newline or <|endoftext|>"
+        if stop_tokens is None or isinstance(stop_tokens, (set, frozenset)):
+            stop_tokens = [stop_tokens or set()] * b
+        assert len(stop_tokens) == b
+        history = [list(p) for p in prompts for _ in range(num_samples)]
+        out = [[] for _ in range(b)]
+        # prefill every distinct prompt once, then repeat its cache rows for all of its samples
+        logits, kv_cache = self.prefill([list(p)[-block_size:] for p in prompts], prefix_cache)
+        if num_samples > 1:
+            rows = torch.arange(len(prompts), device=device).repeat_interleave(num_samples)
+            kv_cache.select(rows)
+            logits = logits[rows]
+        settings = [temperature, top_k, top_p, repetition_penalty]
+        for s in settings:
+            assert not isinstance(s, (list, tuple)) or len(s) == b, "expected one sampling setting per returned row"
+        active = list(range(b)) # row indices (into out) of the sequences still being generated
+        for step in range(max_new_tokens):
+            # the settings of the active rows, in their order in the batch
+            t, k, p, penalty = [[s[i] for i in active] if isinstance(s, (list, tuple)) else s for s in settings]
+            prev = None
+            if repetition_penalty is not None:
+                # recent tokens of every row, padded by repeating the row's first one
+                recent = [history[i][-block_size:] for i in active]
+                width = max(len(h) for h in recent)
+                prev = torch.tensor([h[:1] * (width - len(h)) + h for h in recent], dtype=torch.long, device=device)
+            idx_next = self.sample_next(logits, t, k, p, penalty, prev)
+            # a single device sync per step for the whole batch
+            keep = []
+            for j, tok in enumerate(idx_next[:, 0].tolist()):
+                i = active[j]
+                out[i].append(tok)
+                history[i].append(tok)
+                if tok not in stop_tokens[i] and not (stop_fn is not None and stop_fn(i, out[i])):
+                    keep.append(j)
+            if not keep or step == max_new_tokens - 1:
+                break
+            if len(keep) < len(active):
+                # remove the finished rows from the running batch
+                active = [active[j] for j in keep]
+                keep = torch.tensor(keep, device=device)
+                kv_cache.select(keep)
+                idx_next = idx_next[keep]
+            if kv_cache.length < block_size:
+                logits, _ = self(idx_next, kv_cache=kv_cache)
+            else:
+                # the cache is full: re-encode the end of every row, leaving room for rolling_stride - 1 tokens
+                context = block_size - rolling_stride + 1
+                logits, kv_cache = self.prefill([history[i][-context:] for i in active])
+        return out
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, max_new_tokens, draft_model, k=4, temperature=1.0, top_k=None, stats=None):
+        """
+        Speculative decoding: the small draft_model proposes k tokens one by one, and this model
+        scores all of them in a single forward pass. Each proposal is accepted or resampled with
+        rejection sampling, so the output follows exactly the same distribution as generate() with
+        the same temperature and top_k (0 is greedy, then exactly the same tokens). Only a batch of
+        one sequence is supported. If a dict is
+        passed as stats, it is filled with the number of rounds (= forward passes of this model)
+        and the number of drafted and accepted tokens.
+        """
+        assert idx.size(0) == 1, "speculative decoding only supports a batch of one sequence"
+        stats = {} if stats is None else stats
+        stats.update(rounds=0, drafted=0, accepted=0)
+        device, V = idx.device, self.config.vocab_size
+        block_size = min(self.config.block_size, draft_model.config.block_size)
+        tokens = idx[0].tolist()
+        n_new = 0
+        if len(tokens) <= block_size:
+            cache = KVCache(self.config, 1, device=device, dtype=self.transformer.wpe.weight.dtype)
+            draft_cache = KVCache(draft_model.config, 1, device=device, dtype=draft_model.transformer.wpe.weight.dtype)
+            # both caches hold every token except the last one, which is fed at the start of a round
+            if len(tokens) > 1:
+                self(idx[:, :-1], kv_cache=cache)
+                draft_model(idx[:, :-1], kv_cache=draft_cache)
+            pending = tokens[-1:] # tokens the draft model has not seen yet
+        while n_new < max_new_tokens and len(tokens) <= block_size:
+            L = len(tokens)
+            kr = min(k, max_new_tokens - n_new - 1, block_size - L) # don't draft past the end
+            # 1) draft kr tokens autoregressively with the small model
+            proposal, q = [], []
+            x = torch.tensor([pending], dtype=torch.long, device=device)
+            for _ in range(kr):
+                logits, _ = draft_model(x, kv_cache=draft_cache)
+                logits = logits[:, -1, :V] # match the vocabularies, the draft can't propose what we can't score
+                if logits.size(-1) < V:
+                    logits = F.pad(logits, (0, V - logits.size(-1)), value=-float('Inf'))
+                q.append(self._probs(logits, temperature, top_k))
+                x = torch.multinomial(q[-1], num_samples=1)
+                proposal.append(x)
+            # 2) score the last token and all proposals with this model in one forward pass
+            x = torch.cat([idx.new_tensor([[tokens[-1]]])] + proposal, dim=1)
+            logits, _ = self(x, kv_cache=cache, all_logits=True)
+            p = self._probs(logits[0], temperature, top_k) # (kr+1, V)
+            # 3) accept proposal j with probability min(1, p(x_j) / q(x_j)), up to the first rejection
+            n = 0
+            if kr > 0:
+                proposal = torch.cat(proposal, dim=1)[0]
+                q = torch.cat(q)
+                j = torch.arange(kr, device=device)
+                accept = torch.rand(kr, device=device) * q[j, proposal] < p[j, proposal]
+                n = int(accept.cumprod(0).sum())
+                proposal = proposal.tolist()
+            if n < kr:
+                # rejected: resample from the residual distribution max(0, p - q)
+                residual = (p[n] - q[n]).clamp(min=0)
+                t = torch.multinomial(residual / residual.sum(), num_samples=1).item()
+            else:
+                # all accepted: we get one more token from this model for free
+                t = torch.multinomial(p[kr], num_samples=1).item()
+            new = proposal[:n] + [t]
+            stats['rounds'] += 1
+            stats['drafted'] += kr
+            stats['accepted'] += n
+            # roll both caches back to just before the token sampled last
+            cache.crop(L + n)
+            draft_len = min(L + kr - 1, L + n) if kr > 0 else L - len(pending)
+            draft_cache.crop(draft_len)
+            tokens += new
+            pending = tokens[draft_len:]
+            for tok in new[:max_new_tokens - n_new]:
+                yield tok
+            n_new += len(new)
+        if n_new < max_new_tokens:
+            # out of context: continue with the plain sliding-window generation
+            yield from self.generate(idx.new_tensor([tokens]), max_new_tokens - n_new, temperature=temperature, top_k=top_k)
@@ -0,0 +1,202 @@
+# fmt: off
+
+"""
+Tokenizes a corpus of local text files into a sharded split (see dataset.py), for corpora of any
+size: the files are cut into chunks of chunk_size bytes that a pool of num_proc processes encode in
+parallel, and the tokens are appended to the shards in order, with only a few chunks in flight at
+any time. Memory use doesn't depend on the size of the corpus, and the speed scales with the number
+of cores. Every file is one document, that ends with <|endoftext|> for the BPE tokenizers.
+
+Chunks are cut at line breaks or before words, at places where the GPT-2 regex splits the text
+anyway, so the tokens are exactly those of encoding every file in one go. Each worker finds the
+cut points near the ends of its chunk itself, so the main process never reads any text.
+
+The progress is saved to data/<dataset>/<split>.progress.json with every shard written, and running
+the same command again after an interruption continues from there.
+
+$ python prepare.py --input=path/to/corpus --dataset=mycorpus --split=train --tokenizer=gpt2
+$ python prepare.py --input='path/to/heldout/*.txt' --dataset=mycorpus --split=val --tokenizer=gpt2
+
+input is a file, a directory (all files in it, recursively) or a glob pattern. tokenizer is the
+name of a tiktoken encoding, or 'char' for a character vocab, which is collected from the corpus in
+a first pass and saved to meta.pkl unless data/<dataset>/meta.pkl exists already (e.g. for val).
+"""
+import os
+import re
+import glob
+import json
+import time
+import mmap
+import pickle
+import itertools
+import collections
+import multiprocessing as mp
+
+import numpy as np
+
+from codec import Codec
+from dataset import ShardWriter, index_path
+
+def list_files(input):
+    if os.path.isdir(input):
+        return sorted(os.path.join(root, f) for root, _, files in os.walk(input) for f in files)
+    return sorted(glob.glob(input))
+
+# the GPT-2 regex always splits right after a line break between two printable ASCII characters,
+# and right before a space that is between one and an ASCII letter
+_cut = re.compile(rb'[!-~](?:\n(?=[!-~])|(?= [A-Za-z]))')
+
+def cut_point(text, pos, max_search):
+    """ where to cut the bytes text near pos, the same for the chunks on either side of the cut """
+    if pos == 0 or pos >= len(text):
+        return min(pos, len(text))
+    if m := _cut.search(text, pos - 1, pos + max_search):
+        return m.end()
+    if (i := text.find(b'\n', pos, pos + max_search)) != -1:
+        return i + 1 # no clean cut, the tokens around this line break might differ slightly
+    while pos < len(text) and text[pos] & 0xC0 == 0x80: # at least not inside a UTF-8 character
+        pos += 1
+    return pos
+
+# -----------------------------------------------------------------------------
+# the workers
+
+_worker = {}
+
+def _init_worker(tokenizer, meta_path):
+    if tokenizer == 'char':
+        _worker['encode'] = Codec(meta_path).encode_array
+        _worker['eot'] = None
+    else:
+        import tiktoken
+        enc = tiktoken.get_encoding(tokenizer)
+        _worker['encode'] = enc.encode_ordinary
+        _worker['eot'] = enc.eot_token
+
+def _read_chunk(path, a, b, chunk_size):
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        start, end = cut_point(m, a, chunk_size), cut_point(m, b, chunk_size)
+        # a broken byte here and there shouldn't stop a long run, it becomes U+FFFD
+        return m[start:end].decode('utf-8', errors='replace'), end == len(m)
+
+def _chunk_chars(task):
+    text, _ = _read_chunk(*task)
+    return set(text)
+
+def _encode_chunk(task):
+    text, last = _read_chunk(*task)
+    try:
+        ids = np.asarray(_worker['encode'](text), dtype=np.int64)
+    except KeyError as e:
+        raise ValueError(f"{task[0]} has the character {e} that is not in the vocab") from None
+    if last and _worker['eot'] is not None:
+        ids = np.append(ids, _worker['eot'])
+    return ids
+
+# -----------------------------------------------------------------------------
+
+if __name__ == '__main__':
+    input = ''
+    dataset = ''
+    split = 'train'
+    tokenizer = 'gpt2' # a tiktoken encoding, or 'char'
+    num_proc = os.cpu_count()
+    chunk_size = 4 * 2**20 # bytes of text per task
+    shard_size = 100_000_000 # tokens per shard
+    log_interval = 10 # seconds
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    assert input and dataset, "set --input and --dataset"
+    data_dir = os.path.join('data', dataset)
+    os.makedirs(data_dir, exist_ok=True)
+    # a chunk is cut at most chunk_size bytes after its end, and has at most a token per byte, plus the eot
+    assert 2 * chunk_size + 1 <= shard_size, "chunk_size is too large for shard_size"
+
+    files = [(path, os.path.getsize(path)) for path in list_files(input)]
+    assert files, f"no files in {input}"
+    tasks = [(path, a, min(a + chunk_size, size), chunk_size) for path, size in files for a in range(0, size, chunk_size)]
+    total_bytes = sum(size for _, size in files)
+
+    # continue where an earlier run of the same command stopped
+    progress_path = os.path.join(data_dir, f'{split}.progress.json')
+    progress = {'files': files, 'tokenizer': tokenizer, 'chunk_size': chunk_size, 'tasks': 0, 'shards': 0, 'done': False}
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            saved = json.load(f)
+        assert [saved[k] for k in ('tokenizer', 'chunk_size')] == [tokenizer, chunk_size] and [tuple(f) for f in saved['files']] == files, \
+            f"{progress_path} is from preparing other files or with other settings, delete it to start over"
+        progress = saved
+        if progress['done']:
+            print(f"{split} of {data_dir} is prepared already")
+            exit()
+        print(f"continuing after {progress['tasks']} of {len(tasks)} chunks")
+    elif os.path.exists(index_path(data_dir, split)):
+        # the corpus goes into new shards after the split's existing ones
+        with open(index_path(data_dir, split)) as f:
+            progress['shards'] = len(json.load(f)['shards'])
+
+    def save_progress():
+        with open(progress_path + '.tmp', 'w') as f:
+            json.dump(progress, f)
+        os.replace(progress_path + '.tmp', progress_path)
+    save_progress()
+
+    # the vocab, either the one of the tokenizer or, for char, of the corpus
+    meta_path = None
+    if tokenizer == 'char':
+        meta_path = os.path.join(data_dir, 'meta.pkl')
+        if not os.path.exists(meta_path):
+            chars = set()
+            with mp.Pool(num_proc) as pool:
+                for chunk_chars in pool.imap_unordered(_chunk_chars, tasks):
+                    chars |= chunk_chars
+            chars = sorted(chars)
+            print(f"vocab size: {len(chars):,}")
+            meta = {'vocab_size': len(chars), 'itos': dict(enumerate(chars)), 'stoi': {c: i for i, c in enumerate(chars)}}
+            with open(meta_path, 'wb') as f:
+                pickle.dump(meta, f)
+    vocab_size = Codec(meta_path, tokenizer).vocab_size
+
+    writer = ShardWriter(data_dir, split, vocab_size, shard_size) # in uint8/16/32, whatever the vocab needs
+    # shards an interrupted run wrote after it last saved its progress are written again
+    writer.index['shards'] = writer.index['shards'][:progress['shards']]
+    pending_tokens = collections.deque() # (tokens up to and including a chunk, chunks so far), for chunks not in a shard yet
+    tokens = sum(s['num_tokens'] for s in writer.index['shards'])
+    done_bytes = sum(b - a for _, a, b, _ in tasks[:progress['tasks']])
+    t0 = t_log = time.time()
+    bytes0 = done_bytes
+
+    with mp.Pool(num_proc, initializer=_init_worker, initargs=(tokenizer, meta_path)) as pool:
+        # keep every worker busy, but only a few chunks ahead of the writing
+        queued = iter(range(progress['tasks'], len(tasks)))
+        results = collections.deque((t, pool.apply_async(_encode_chunk, (tasks[t],))) for t in itertools.islice(queued, 2 * num_proc))
+        while results:
+            t, result = results.popleft()
+            ids = result.get()
+            for t_next in itertools.islice(queued, 1):
+                results.append((t_next, pool.apply_async(_encode_chunk, (tasks[t_next],))))
+            path, a, b, _ = tasks[t]
+            num_shards = len(writer.index['shards'])
+            writer.write(ids, [0] if a == 0 else [], whole=True) # whole: shards end with a chunk
+            if t == len(tasks) - 1:
+                writer.close()
+            tokens += len(ids)
+            done_bytes += b - a
+            pending_tokens.append((tokens, t + 1))
+            if len(writer.index['shards']) > num_shards:
+                # the chunks whose tokens are all in shards now don't have to be encoded again
+                in_shards = sum(s['num_tokens'] for s in writer.index['shards'])
+                while pending_tokens and pending_tokens[0][0] <= in_shards:
+                    progress['tasks'] = pending_tokens.popleft()[1]
+                progress['shards'] = len(writer.index['shards'])
+                save_progress()
+            if time.time() - t_log > log_interval or t == len(tasks) - 1:
+                t_log = time.time()
+                mbps = (done_bytes - bytes0) / 1e6 / (t_log - t0)
+                eta = (total_bytes - done_bytes) / 1e6 / max(mbps, 1e-9)
+                print(f"{done_bytes/1e6:,.0f}/{total_bytes/1e6:,.0f}MB ({done_bytes/max(total_bytes, 1)*100:.1f}%), "
+                      f"{mbps:.2f}MB/s, {tokens:,} tokens, eta {eta/60:.1f}min")
+
+    progress.update(tasks=len(tasks), shards=len(writer.index['shards']), done=True)
+    save_progress()
+    print(f"{split} of {data_dir} has {tokens:,} tokens in {len(writer.index['shards'])} shards")
@@ -0,0 +1,176 @@
+# fmt: off
+
+"""
+Int8 weight-only quantization of a GPT, for cheaper (memory-bandwidth bound) inference on CPU.
+Every nn.Linear, including the lm_head and with it the tied token embedding, gets int8 weights
+with one float scale per output channel. Activations stay in float.
+
+Convert a checkpoint (or a GPT-2 model), compare it against the float model and save it:
+$ python quantize.py --out_dir=out-shakespeare-char --device=cpu
+$ python quantize.py --init_from=gpt2-xl --out_dir=out-gpt2-xl --device=cpu
+
+This writes out_dir/ckpt_int8.pt, which sample.py and serve.py load with --init_from=int8.
+"""
+import os
+import math
+import time
+from dataclasses import asdict
+
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from model import GPTConfig, GPT
+
+# fused int8 weight x float activation matmul, available in recent PyTorch versions. On CPU it beats
+# a float32 matmul by ~2.5x for a single row, but falls behind the float32 path beyond a few dozen rows
+int8_mm_available = hasattr(torch, '_weight_int8pack_mm')
+int8_mm_max_rows = 32
+
+def quantize_weight(w):
+    # symmetric per-output-channel quantization: w ~= q * scales[:, None]
+    w = w.detach().float()
+    scales = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+    q = torch.round(w / scales[:, None]).clamp(-127, 127).to(torch.int8)
+    return q, scales
+
+class Int8Linear(nn.Module):
+    """ nn.Linear with int8 weights and one float scale per output channel """
+
+    def __init__(self, weight, scales, bias=None):
+        super().__init__()
+        self.in_features, self.out_features = weight.size(1), weight.size(0)
+        # frozen parameters (rather than buffers), so that weight tying survives .to(device)
+        self.weight = nn.Parameter(weight, requires_grad=False)
+        self.scales = nn.Parameter(scales, requires_grad=False)
+        self.bias = nn.Parameter(bias.detach().clone(), requires_grad=False) if bias is not None else None
+
+    @classmethod
+    def from_linear(cls, linear):
+        return cls(*quantize_weight(linear.weight), linear.bias)
+
+    def forward(self, x):
+        if int8_mm_available and x.device.type == 'cpu' and x.numel() <= int8_mm_max_rows * self.in_features:
+            # few rows, i.e. decoding: the fused int8 kernel, which is only fast with bfloat16 activations
+            x2 = x.reshape(-1, self.in_features).to(torch.bfloat16).contiguous()
+            y = torch._weight_int8pack_mm(x2, self.weight, self.scales.to(torch.bfloat16)).to(x.dtype)
+            y = y.view(*x.shape[:-1], self.out_features)
+        else:
+            # many rows (prefill, evaluation): dequantize on the fly. The per-channel scale commutes
+            # with the matmul, so it's applied to the output
+            y = F.linear(x, self.weight.to(x.dtype)) * self.scales.to(x.dtype)
+        if self.bias is not None:
+            y = y + self.bias.to(y.dtype)
+        return y
+
+class Int8Embedding(nn.Module):
+    """ embedding lookup into the int8 weights of the (tied) lm_head """
+
+    def __init__(self, weight, scales):
+        super().__init__()
+        self.weight = weight
+        self.scales = scales
+
+    def forward(self, idx):
+        return F.embedding(idx, self.weight).float() * self.scales[idx][..., None]
+
+def quantize_int8(model):
+    """ convert a GPT in place to int8 weight-only, and return it """
+    for module in list(model.modules()):
+        for name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                setattr(module, name, Int8Linear.from_linear(child))
+    # re-tie the token embedding to the quantized lm_head
+    model.transformer.wte = Int8Embedding(model.lm_head.weight, model.lm_head.scales)
+    return model
+
+def save_quantized(model, path, config=None):
+    checkpoint = {
+        'model': model.state_dict(),
+        'model_args': asdict(model.config),
+        'quantization': 'int8',
+        'config': config or {},
+    }
+    torch.save(checkpoint, path)
+
+def load_quantized(path, device='cpu'):
+    """ load a checkpoint written by save_quantized, returns the model and the checkpoint dict """
+    checkpoint = torch.load(path, map_location=device)
+    assert checkpoint.get('quantization') == 'int8', f"{path} is not an int8 checkpoint"
+    # build the int8 model on the meta device, so that no float weights are allocated, initialized and
+    # quantized only to be overwritten, and assign the loaded tensors (like ckpt.model_from_state_dict)
+    with torch.device('meta'):
+        model = quantize_int8(GPT(GPTConfig(**checkpoint['model_args'])))
+    model.load_state_dict(checkpoint['model'], assign=True)
+    # assign=True gives the keys of the tied weights separate parameters, tie them again
+    model.transformer.wte.weight = model.lm_head.weight
+    model.transformer.wte.scales = model.lm_head.scales
+    model.eval()
+    model.to(device)
+    return model, checkpoint
+
+if __name__ == '__main__':
+    from sample import load_model
+    from dataset import open_tokens, exists as data_exists
+    # -----------------------------------------------------------------------------
+    init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+    out_dir = 'out' # the quantized checkpoint is written to out_dir/ckpt_int8.pt
+    dataset = 'openwebtext' # val split used for the perplexity comparison, if the checkpoint has no dataset of its own
+    eval_iters = 20 # number of val batches for the perplexity comparison
+    batch_size = 4
+    block_size = 256 # context of the perplexity comparison
+    max_new_tokens = 100 # number of tokens generated for the tokens/sec comparison
+    save = True # write the quantized checkpoint
+    seed = 1337
+    device = 'cpu' # int8 weight-only is aimed at CPU inference, but works on other devices too
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    torch.manual_seed(seed)
+    model, meta_path = load_model(init_from, out_dir, device)
+    if meta_path is not None:
+        dataset = os.path.basename(os.path.dirname(meta_path))
+    block_size = min(block_size, model.config.block_size)
+
+    # fixed set of val windows, so that both models are scored on exactly the same tokens
+    data_dir = os.path.join('data', dataset)
+    batches = []
+    if data_exists(data_dir, 'val'):
+        data = open_tokens(data_dir, 'val')
+        for _ in range(eval_iters):
+            ix = torch.randint(len(data) - block_size, (batch_size,))
+            x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
+            y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+            batches.append((x.to(device), y.to(device)))
+    else:
+        print(f"no val split in {data_dir}, skipping the perplexity comparison")
+
+    @torch.no_grad()
+    def evaluate(model):
+        losses = [model(x, y)[1].item() for x, y in batches]
+        ppl = math.exp(sum(losses) / len(losses)) if losses else float('nan')
+        prompt = torch.zeros((1, 1), dtype=torch.long, device=device)
+        list(model.generate(prompt, 10)) # warmup
+        t0 = time.time()
+        list(model.generate(prompt, max_new_tokens))
+        return ppl, max_new_tokens / (time.time() - t0)
+
+    ppl_fp, tps_fp = evaluate(model)
+    weight_bytes_fp = sum(p.numel() * p.element_size() for p in model.parameters())
+    model = quantize_int8(model)
+    ppl_q, tps_q = evaluate(model)
+    weight_bytes_q = sum(p.numel() * p.element_size() for p in model.parameters())
+
+    print(f"{'':>8} {'weights':>10} {'val ppl':>10} {'tokens/s':>10}")
+    print(f"{'float':>8} {weight_bytes_fp/1e6:>8.1f}MB {ppl_fp:>10.4f} {tps_fp:>10.1f}")
+    print(f"{'int8':>8} {weight_bytes_q/1e6:>8.1f}MB {ppl_q:>10.4f} {tps_q:>10.1f}")
+    print(f"perplexity delta {ppl_q - ppl_fp:+.4f} ({(ppl_q/ppl_fp - 1)*100:+.2f}%), speedup {tps_q/tps_fp:.2f}x")
+    if not int8_mm_available:
+        print("note: this PyTorch has no fused int8 matmul, weights are dequantized on the fly")
+
+    if save:
+        os.makedirs(out_dir, exist_ok=True)
+        path = os.path.join(out_dir, 'ckpt_int8.pt')
+        print(f"saving quantized checkpoint to {path}")
+        save_quantized(model, path, config={'dataset': dataset} if meta_path is not None else {})
@@ -4,47 +4,141 @@
 Sample from a trained model
 """
 import os
-import pickle
+import time
 from contextlib import nullcontext
 import torch
-import tiktoken
-from model import GPTConfig, GPT
+from model import GPTConfig, GPT, PrefixCache
+from quantize import load_quantized
+from codec import get_codec
+import ckpt
+
+def load_model(init_from='resume', out_dir='out', device='cuda'):
+    """
+    Load a GPT in eval mode, either from the training checkpoint in out_dir (init_from='resume'),
+    from the inference export out_dir/model.bin written by ckpt.py (init_from='export'), from the
+    int8 checkpoint out_dir/ckpt_int8.pt written by quantize.py (init_from='int8') or from the
+    OpenAI GPT-2 weights (init_from='gpt2*'). Also returns the path to the meta.pkl of the
+    dataset it was trained on, or None if there is none and GPT-2 encodings should be used.
+    """
+    if init_from == 'resume' and ckpt.is_latest(out_dir):
+        # memory-map the weights of a checkpoint in the ckpt.py format, skipping the optimizer state
+        checkpoint = ckpt.load_checkpoint(out_dir, optimizer=False)
+        if checkpoint.get('sharded'): # written by the ranks of an FSDP run in parallel, see ckpt.save_sharded
+            checkpoint['model'] = ckpt.load_sharded_model(out_dir, checkpoint['model_args'], checkpoint['iter_num'])
+        model = ckpt.model_from_state_dict(checkpoint['model_args'], checkpoint['model'])
+    elif init_from == 'resume':
+        # init from a model saved in a specific directory
+        ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+        checkpoint = torch.load(ckpt_path, map_location=device)
+        if checkpoint.get('sharded'):
+            checkpoint['model'] = ckpt.load_sharded_model(out_dir, checkpoint['model_args'], checkpoint['iter_num'])
+        gptconf = GPTConfig(**checkpoint['model_args'])
+        model = GPT(gptconf)
+        state_dict = checkpoint['model']
+        unwanted_prefix = '_orig_mod.'
+        for k,v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+        model.load_state_dict(state_dict)
+    elif init_from == 'export':
+        # init from the weights-only export written by ckpt.py
+        model, checkpoint = ckpt.load_export(os.path.join(out_dir, 'model.bin'))
+    elif init_from == 'int8':
+        # init from an int8 weight-only checkpoint written by quantize.py
+        model, checkpoint = load_quantized(os.path.join(out_dir, 'ckpt_int8.pt'), device)
+    elif init_from.startswith('gpt2'):
+        # init from a given GPT-2 model
+        model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+
+    model.eval()
+    model.to(device)
+
+    # look for the meta pickle in case it is available in the dataset folder
+    load_meta = False
+    if init_from in ('resume', 'export', 'int8') and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
+        meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
+        load_meta = os.path.exists(meta_path)
+    if load_meta:
+        print(f"Loading meta from {meta_path}...")
+    else:
+        # ok let's assume gpt-2 encodings by default
+        meta_path=None
+        print("No meta.pkl found, assuming GPT-2 encodings...")
+    return model, meta_path
 
 def generate_sample(
         model, start="\n", max_new_tokens=50, temperature=0.8, top_k=200,
-        device='cuda', meta_path=None):
-    # Load meta if available
-    if meta_path:
-        with open(meta_path, "rb") as f:
-            meta = pickle.load(f)
-        stoi, itos = meta["stoi"], meta["itos"]
-        encode = lambda s: [stoi[c] for c in s]
-        decode = lambda l: "".join([itos[i] for i in l])
-    else:
-        enc = tiktoken.get_encoding("gpt2")
-        encode = lambda s: enc.encode(s, allowed_special={""})
-        decode = lambda l: enc.decode(l)
+        device='cuda', meta_path=None, use_kv_cache=True, draft_model=None, speculative_k=4, stats=None,
+        prefix_cache=None, rolling_stride=1, top_p=None, repetition_penalty=None):
+    codec = get_codec(meta_path) # loaded once, not at every call
 
     # Encode the beginning of the prompt
-    start_ids = encode(start)
+    start_ids = codec.encode(start)
     x = torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...]
 
-    # Run generation
-    generator = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
+    # Run generation, speculatively if a draft model is given
+    if draft_model is not None:
+        assert top_p is None and repetition_penalty is None, "speculative decoding only supports temperature and top_k"
+        generator = model.generate_speculative(
+            x, max_new_tokens, draft_model, k=speculative_k, temperature=temperature, top_k=top_k, stats=stats)
+    else:
+        generator = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, use_kv_cache=use_kv_cache,
+                                   prefix_cache=prefix_cache, rolling_stride=rolling_stride,
+                                   top_p=top_p, repetition_penalty=repetition_penalty)
+    # a token can end inside a multi-byte character, which then comes with the token that completes it
+    detokenizer = codec.detokenizer()
     for token in generator:
-        yield decode([token])
+        yield detokenizer.decode([token])
+    if rest := detokenizer.flush():
+        yield rest
+
+def generate_samples(
+        model, starts, num_samples=1, max_new_tokens=50, temperature=0.8, top_k=200,
+        meta_path=None, stop=(), stop_tokens=None, prefix_cache=None, rolling_stride=1,
+        top_p=None, repetition_penalty=None):
+    """
+    Draw num_samples completions for each of the prompt strings in starts as one batch.
+    Each sample ends at its first stop string (not included), at one of the stop_tokens,
+    or after max_new_tokens. An empty prompt starts from "\n", as in serve.py. Returns the
+    completions in the order of GPT.generate_batch.
+    """
+    codec = get_codec(meta_path)
+    encode, decode = codec.encode, codec.decode
+    stop = [s for s in stop if s]
+    # each new token decodes to at least one character, so a stop string can only have
+    # appeared if it is contained in the decoding of the last len(s) tokens
+    stop_fn = lambda i, toks: any(s in decode(toks[-len(s):]) for s in stop)
+    outs = model.generate_batch(
+        [encode(s) or encode("\n") for s in starts], max_new_tokens, temperature=temperature, top_k=top_k,
+        num_samples=num_samples, stop_tokens=stop_tokens, stop_fn=stop_fn if stop else None,
+        prefix_cache=prefix_cache, rolling_stride=rolling_stride, top_p=top_p, repetition_penalty=repetition_penalty)
+    samples = []
+    for toks in outs:
+        text = decode(toks)
+        cut = min([text.find(s) for s in stop if s in text], default=len(text))
+        samples.append(text[:cut])
+    return samples
 
 
 if __name__ == "__main__":
     # -----------------------------------------------------------------------------
-    init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
-    out_dir = 'out' # ignored if init_from is not 'resume'
+    init_from = 'resume' # either 'resume' (from an out_dir), 'export' or 'int8' (exported/quantized model in out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+    out_dir = 'out' # ignored if init_from is a gpt2 variant
     start = "\n" # or "<|endoftext|>" or etc. Can also specify a file, use as: "FILE:prompt.txt"
     streaming = True # print tokens one by one
+    batched = False # generate all samples at once as one batch (disables streaming)
+    stop = "" # if non-empty, end each batched sample at the first occurrence of this string
     num_samples = 10 # number of samples to draw
     max_new_tokens = 500 # number of tokens generated in each sample
     temperature = 0.8 # 1.0 = no change, < 1.0 = less random, > 1.0 = more random, in predictions
     top_k = 200 # retain only the top_k most likely tokens, clamp others to have 0 probability
+    top_p = None # if set, retain only the most likely tokens whose probabilities add up to top_p (nucleus sampling)
+    repetition_penalty = None # if set (> 1.0), discourage tokens that already appear in the sequence
+    use_kv_cache = True # cache keys/values so each step only forwards the newest token
+    draft = '' # speculative decoding with a small draft model: a gpt2 variant or the out_dir of a checkpoint
+    speculative_k = 4 # number of tokens the draft model proposes per forward pass of the main model
+    rolling_stride = 1 # past block_size, re-encode the context every this many tokens: 1 = exact but slow, see GPT.generate
+    prefix_cache_mb = 0 # if > 0, reuse the keys/values of the prompt across samples, within this memory budget
     seed = 1337
     device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
     dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
@@ -61,62 +155,84 @@ if __name__ == "__main__":
     ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
     ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
-    # model
-    if init_from == 'resume':
-        # init from a model saved in a specific directory
-        ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-        checkpoint = torch.load(ckpt_path, map_location=device)
-        gptconf = GPTConfig(**checkpoint['model_args'])
-        model = GPT(gptconf)
-        state_dict = checkpoint['model']
-        unwanted_prefix = '_orig_mod.'
-        for k,v in list(state_dict.items()):
-            if k.startswith(unwanted_prefix):
-                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-        model.load_state_dict(state_dict)
-    elif init_from.startswith('gpt2'):
-        # init from a given GPT-2 model
-        model = GPT.from_pretrained(init_from, dict(dropout=0.0))
-
-    model.eval()
-    model.to(device)
+    model, meta_path = load_model(init_from, out_dir, device)
     if compile:
         model = torch.compile(model) # requires PyTorch 2.0 (optional)
-
-    # look for the meta pickle in case it is available in the dataset folder
-    load_meta = False
-    if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
-        meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
-        load_meta = os.path.exists(meta_path)
-    if load_meta:
-        print(f"Loading meta from {meta_path}...")
-    else:
-        # ok let's assume gpt-2 encodings by default
-        meta_path=None
-        print("No meta.pkl found, assuming GPT-2 encodings...")
+    prefix_cache = PrefixCache(prefix_cache_mb * 1024**2) if prefix_cache_mb > 0 else None
+    if start.startswith('FILE:'):
+        with open(start[5:], 'r', encoding='utf-8') as f:
+            start = f.read()
+    draft_model = None
+    if draft:
+        # the draft model must use the same tokenizer as the main model
+        draft_model, _ = load_model(draft, '', device) if draft.startswith('gpt2') else load_model('resume', draft, device)
 
     # run generation
     with torch.no_grad():
         with ctx:
             print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-            for k in range(num_samples):
-                try:
-                    generator = generate_sample(
-                        model=model,
-                        start=start,
-                        max_new_tokens=max_new_tokens,
-                        temperature=temperature,
-                        top_k=top_k,
-                        device=device,
-                        meta_path=meta_path,
-                    )
-                    if streaming:
-                        print(start)
-                        for token in generator:
-                            print(token, end='', flush=True)
-                    else:
-                        print("".join(generator), end='')
+            if batched:
+                samples = generate_samples(
+                    model=model,
+                    starts=[start],
+                    num_samples=num_samples,
+                    max_new_tokens=max_new_tokens,
+                    temperature=temperature,
+                    top_k=top_k,
+                    top_p=top_p,
+                    repetition_penalty=repetition_penalty,
+                    meta_path=meta_path,
+                    stop=[stop],
+                    prefix_cache=prefix_cache,
+                    rolling_stride=rolling_stride,
+                )
+                for sample in samples:
+                    print(start + sample)
                     print("...")
                     print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
-                except KeyboardInterrupt:
-                    break
+            else:
+                stats = {}
+                for k in range(num_samples):
+                    try:
+                        t0 = time.time()
+                        generator = generate_sample(
+                            model=model,
+                            start=start,
+                            max_new_tokens=max_new_tokens,
+                            temperature=temperature,
+                            top_k=top_k,
+                            top_p=top_p,
+                            repetition_penalty=repetition_penalty,
+                            device=device,
+                            meta_path=meta_path,
+                            use_kv_cache=use_kv_cache,
+                            draft_model=draft_model,
+                            speculative_k=speculative_k,
+                            stats=stats,
+                            prefix_cache=prefix_cache,
+                            rolling_stride=rolling_stride,
+                        )
+                        n = 0
+                        if streaming:
+                            print(start)
+                            for token in generator:
+                                print(token, end='', flush=True)
+                                n += 1
+                        else:
+                            pieces = list(generator)
+                            n = len(pieces)
+                            print("".join(pieces), end='')
+                        print("...")
+                        dt = time.time() - t0
+                        if draft_model is not None:
+                            # each round is one forward pass of the main model, vs. one per token without a draft
+                            print(f"{n} tokens in {dt:.2f}s ({n/dt:.1f} tokens/s), draft acceptance rate "
+                                  f"{stats['accepted']/max(1, stats['drafted']):.2%}, "
+                                  f"{n/max(1, stats['rounds']):.2f} tokens per forward pass of the main model")
+                        else:
+                            print(f"{n} tokens in {dt:.2f}s ({n/dt:.1f} tokens/s)")
+                        print("~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~")
+                    except KeyboardInterrupt:
+                        break
+            if prefix_cache is not None:
+                print(f"prefix cache: {prefix_cache.stats()}")
@@ -0,0 +1,125 @@
+# fmt: off
+
+"""
+Vectorized next-token sampling with per-row settings, so that requests with different
+temperature / top_k / top_p / repetition penalty can share one batch. Instead of masking
+the full vocabulary, we only ever sample among the top-k candidates of each row.
+
+Run this file for a microbenchmark against the original masking code path:
+$ python sampler.py --device=cpu
+"""
+import time
+import torch
+from torch.nn import functional as F
+
+def per_row(x, b, default, device, dtype):
+    # a setting is a scalar for the whole batch, or a list/tensor with one value (or None) per row
+    if isinstance(x, torch.Tensor):
+        return x.to(device=device, dtype=dtype).view(-1, 1)
+    if isinstance(x, (list, tuple)):
+        assert len(x) == b, f"expected one setting per row ({b}), got {len(x)}"
+        return torch.tensor([default if v is None else v for v in x], dtype=dtype, device=device).view(-1, 1)
+    return torch.full((b, 1), default if x is None else x, dtype=dtype, device=device)
+
+def host_values(x, default):
+    # the values of a setting that are known on the host without a device sync, or None for a tensor
+    if isinstance(x, torch.Tensor):
+        return None
+    return [default if v is None else v for v in (x if isinstance(x, (list, tuple)) else [x])]
+
+@torch.no_grad()
+def sample(logits, temperature=1.0, top_k=None, top_p=None, repetition_penalty=None, prev=None):
+    """
+    Sample one token for every row of logits (b, vocab_size) and return them as a (b, 1) LongTensor.
+    Each setting is a scalar, or a list/tensor of one value per row, where None means "off":
+    - temperature: divides the logits, 0 means greedy decoding
+    - top_k: only sample among the k most likely tokens
+    - top_p: only sample among the most likely tokens whose cumulative probability reaches p
+    - repetition_penalty: CTRL-style penalty (> 1 discourages) on the tokens in prev (b, n),
+      which should only contain valid tokens of each row (pad by repeating one of them)
+    """
+    b, V = logits.shape
+    device = logits.device
+    logits = logits.float()
+    if repetition_penalty is not None and prev is not None:
+        penalty = per_row(repetition_penalty, b, 1.0, device, logits.dtype)
+        scores = logits.gather(1, prev)
+        scores = torch.where(scores > 0, scores / penalty, scores * penalty)
+        logits = logits.scatter(1, prev, scores)
+    t = per_row(temperature, b, 1.0, device, logits.dtype)
+    temps = host_values(temperature, 1.0)
+    greedy = temps is None or any(v == 0 for v in temps)
+    logits = logits / torch.where(t == 0, 1.0, t)
+
+    if top_k is None and top_p is None:
+        # nothing to crop, sample from the full distribution
+        idx_next = torch.multinomial(F.softmax(logits, dim=-1), num_samples=1)
+    else:
+        # gather the candidates of every row once, sorted from most to least likely
+        ks = host_values(top_k, V)
+        if top_p is not None and host_values(top_p, 1.0) != [1.0]:
+            k_max = V if ks is None or V in ks else max(ks) # rows without top_k need the whole sorted vocabulary
+        else:
+            k_max = int(per_row(top_k, b, V, device, torch.long).max()) if ks is None else max(ks)
+        k_max = max(1, min(k_max, V))
+        vals, idx = torch.topk(logits, k_max) # (b, k_max)
+        ranks = torch.arange(k_max, device=device)
+        if top_k is not None:
+            k = per_row(top_k, b, V, device, torch.long).clamp(min=1)
+            vals = vals.masked_fill(ranks >= k, -float('Inf'))
+        if top_p is not None:
+            p = per_row(top_p, b, 1.0, device, logits.dtype)
+            probs = F.softmax(vals, dim=-1)
+            # drop a candidate once the mass of the candidates before it already reaches p
+            # (the most likely token is always kept)
+            vals = vals.masked_fill((probs.cumsum(-1) - probs >= p) & (ranks > 0), -float('Inf'))
+        choice = torch.multinomial(F.softmax(vals, dim=-1), num_samples=1)
+        idx_next = idx.gather(1, choice)
+    if greedy:
+        idx_next = torch.where(t == 0, logits.argmax(dim=-1, keepdim=True), idx_next)
+    return idx_next
+
+def sample_reference(logits, temperature=1.0, top_k=None):
+    # the original code path of GPT.generate, for the benchmark below
+    logits = logits / temperature
+    if top_k is not None:
+        v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+        logits[logits < v[:, [-1]]] = -float('Inf')
+    probs = F.softmax(logits, dim=-1)
+    return torch.multinomial(probs, num_samples=1)
+
+if __name__ == '__main__':
+    # -----------------------------------------------------------------------------
+    vocab_size = 50304
+    batch_sizes = '1,8,64'
+    top_k = 200
+    iters = 100
+    device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+    seed = 1337
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+    torch.manual_seed(seed)
+    sync = torch.cuda.synchronize if 'cuda' in device else lambda: None
+
+    def timeit(fn):
+        for _ in range(5): # warmup
+            fn()
+        sync()
+        t0 = time.time()
+        for _ in range(iters):
+            fn()
+        sync()
+        return (time.time() - t0) / iters * 1000
+
+    print(f"{'batch':>6} {'reference':>12} {'sampler':>12} {'per-row mix':>12}   (ms per call, vocab {vocab_size}, top_k {top_k})")
+    for b in [int(x) for x in batch_sizes.split(',')]:
+        logits = torch.randn(b, vocab_size, device=device) * 3
+        # heterogeneous batch: every row has its own settings
+        temps = [0.7 + 0.1 * (i % 4) for i in range(b)]
+        ks = [top_k if i % 2 == 0 else 50 for i in range(b)]
+        ps = [0.9 if i % 3 == 0 else None for i in range(b)]
+        prev = torch.randint(vocab_size, (b, 256), device=device)
+        t_ref = timeit(lambda: sample_reference(logits.clone(), 0.8, top_k))
+        t_new = timeit(lambda: sample(logits, 0.8, top_k))
+        t_mix = timeit(lambda: sample(logits, temps, ks, ps, repetition_penalty=1.2, prev=prev))
+        print(f"{b:>6} {t_ref:>12.4f} {t_new:>12.4f} {t_mix:>12.4f}")
@@ -0,0 +1,364 @@
+# fmt: off
+
+"""
+Serve a trained model over a local HTTP/JSON completion endpoint.
+
+Requests are scheduled with continuous (iteration-level) batching: a single scheduler thread
+runs the decode loop, and at every step newly arrived requests are prefilled and joined into the
+running batch, while finished ones are dropped, instead of waiting for the whole batch to drain.
+
+$ python serve.py --out_dir=out-shakespeare-char --device=cpu
+$ curl -s localhost:8000/v1/completions -d '{"prompt": "ROMEO:", "max_tokens": 100}'
+$ curl -sN localhost:8000/v1/completions -d '{"prompt": "ROMEO:", "max_tokens": 100, "stream": true}'
+$ curl -s localhost:8000/stats
+
+A completion request is a JSON object with "prompt" and optionally "max_tokens", "temperature",
+"top_k", "top_p", "repetition_penalty", "stop" (a string or list of strings) and "stream". Without
+streaming the reply is one JSON object; with streaming it is newline-delimited JSON, one object
+per generated piece of text.
+"""
+import json
+import math
+import time
+import queue
+import threading
+import traceback
+from collections import deque
+from contextlib import nullcontext
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import torch
+from model import PrefixCache
+from sample import load_model
+from codec import get_codec
+from benchmark import percentile
+
+# -----------------------------------------------------------------------------
+init_from = 'resume' # either 'resume' (from an out_dir), 'export' or 'int8' (exported/quantized model in out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+out_dir = 'out' # ignored if init_from is a gpt2 variant
+host = '127.0.0.1'
+port = 8000
+max_batch = 16 # max number of sequences decoded together
+max_batch_tokens = 16384 # max sum of prompt + max_tokens over the running batch
+max_queue = 64 # requests waiting beyond this are rejected with 503 (backpressure)
+max_tokens = 256 # upper limit (and default) for max_tokens of a single request
+temperature = 0.8 # default temperature, can be overridden per request
+top_k = 200 # default top_k, can be overridden per request
+top_p = None # default nucleus sampling threshold, can be overridden per request
+repetition_penalty = None # default penalty (> 1.0) on tokens already in the sequence, can be overridden per request
+prefix_cache_mb = 256 # memory budget for keys/values of prompt prefixes shared across requests, 0 disables
+stats_window = 1000 # number of recent requests the latency percentiles are computed over
+seed = 1337
+device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
+compile = False # use PyTorch 2.0 to compile the model to be faster
+# -----------------------------------------------------------------------------
+
+class Request:
+
+    def __init__(self, prompt, max_tokens, temperature, top_k, top_p, repetition_penalty, stop, detokenizer):
+        self.prompt = prompt # list of token ids
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.repetition_penalty = repetition_penalty
+        self.stop = stop # list of stop strings
+        self.hold = max((len(s) for s in stop), default=1) - 1 # trailing characters held back while streaming
+        self.pending = '' # text not streamed yet because it could be the start of a stop string, None after a match
+        self.detokenizer = detokenizer # turns the tokens into the text streamed to the client
+        self.tokens = [] # generated token ids
+        self.events = queue.Queue() # pieces of text for the client, then None when done
+        self.finish_reason = None
+        self.cancelled = False # set by the HTTP thread if the client goes away
+        self.t_submit = time.time()
+        self.t_first = None
+
+class Scheduler:
+    """ runs the decode loop on its own thread and owns the model and the KV cache """
+
+    def __init__(self, model, codec, stop_tokens, ctx, prefix_cache=None):
+        self.model = model
+        self.prefix_cache = prefix_cache
+        self.codec = codec
+        self.stop_tokens = stop_tokens
+        self.ctx = ctx
+        self.block_size = model.config.block_size
+        self.waiting = deque()
+        self.cond = threading.Condition()
+        self.active = [] # requests in the running batch, in the row order of the kv cache
+        self.kv_cache = None
+        self.logits = None # next-token logits of every active row
+        # counters
+        self.completed = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=stats_window)
+        self.ttfts = deque(maxlen=stats_window)
+        self.token_times = deque() # (time, number of tokens) of recent decode steps
+        self.tokens_total = 0
+        self.t_start = time.time()
+
+    def submit(self, prompt, max_new, temperature, top_k, top_p, repetition_penalty, stop):
+        max_new = max(1, min(max_new, max_tokens, self.block_size - 1))
+        # crop the prompt from the left so that prompt + completion fits into the context
+        prompt = self.codec.encode(prompt)[-(self.block_size - max_new):] or self.codec.encode("\n")
+        req = Request(prompt, max_new, temperature, top_k, top_p, repetition_penalty, stop, self.codec.detokenizer())
+        with self.cond:
+            if len(self.waiting) >= max_queue:
+                self.rejected += 1
+                return None
+            self.waiting.append(req)
+            self.cond.notify()
+        return req
+
+    def run(self):
+        with torch.no_grad(), self.ctx:
+            while True:
+                with self.cond:
+                    while not self.waiting and not self.active:
+                        self.cond.wait()
+                self.admit()
+                if self.active:
+                    try:
+                        self.step()
+                    except Exception:
+                        # the batch shares one forward, so a failure takes down all of its rows
+                        traceback.print_exc()
+                        for r in self.active:
+                            if r.finish_reason is None:
+                                self.fail(r)
+                        self.active, self.kv_cache, self.logits = [], None, None
+
+    def admit(self):
+        # move waiting requests into the running batch, within the batch size and token budgets
+        budget = max_batch_tokens - sum(len(r.prompt) + r.max_tokens for r in self.active)
+        new = []
+        with self.cond:
+            while self.waiting and len(self.active) + len(new) < max_batch:
+                req = self.waiting[0]
+                if req.cancelled:
+                    self.waiting.popleft()
+                    continue
+                cost = len(req.prompt) + req.max_tokens
+                if cost > budget and (self.active or new):
+                    break
+                budget -= cost
+                new.append(self.waiting.popleft())
+        if not new:
+            return
+        try:
+            logits, kv_cache = self.model.prefill([r.prompt for r in new], self.prefix_cache)
+        except Exception:
+            traceback.print_exc()
+            for r in new:
+                self.fail(r)
+            return
+        if self.kv_cache is None:
+            self.kv_cache, self.logits = kv_cache, logits
+        else:
+            self.kv_cache.extend(kv_cache)
+            self.logits = torch.cat((self.logits, logits))
+        self.active += new
+
+    def sample(self):
+        # one vectorized call for the whole batch, every row with its own settings
+        active = self.active
+        prev = None
+        if any(r.repetition_penalty is not None for r in active):
+            # the tokens of every row so far, padded by repeating the row's first one
+            seqs = [r.prompt + r.tokens for r in active]
+            width = max(len(s) for s in seqs)
+            prev = torch.tensor([s[:1] * (width - len(s)) + s for s in seqs], dtype=torch.long, device=self.logits.device)
+        return self.model.sample_next(
+            self.logits, [r.temperature for r in active], [r.top_k for r in active],
+            [r.top_p for r in active], [r.repetition_penalty for r in active], prev)
+
+    def step(self):
+        idx_next = self.sample()
+        now = time.time()
+        keep = []
+        for i, tok in enumerate(idx_next[:, 0].tolist()): # one device sync per step
+            r = self.active[i]
+            r.t_first = r.t_first or now
+            r.tokens.append(tok)
+            if tok in self.stop_tokens:
+                r.finish_reason = 'stop'
+            else:
+                if self.emit(r, r.detokenizer.decode([tok])): # '' while inside a multi-byte character
+                    r.finish_reason = 'stop'
+                elif len(r.tokens) >= r.max_tokens:
+                    r.finish_reason = 'length'
+            if r.cancelled:
+                r.finish_reason = 'cancelled'
+            if r.finish_reason is None:
+                keep.append(i)
+            else:
+                self.finish(r, now)
+        self.record_tokens(now, len(self.active))
+        if len(keep) < len(self.active):
+            self.active = [self.active[i] for i in keep]
+            if not keep:
+                self.kv_cache, self.logits = None, None
+                return
+            keep = torch.tensor(keep, device=idx_next.device)
+            self.kv_cache.select(keep)
+            idx_next = idx_next[keep]
+        # prompt + max_tokens <= block_size for every request, so the cache can never overflow
+        self.logits, _ = self.model(idx_next, kv_cache=self.kv_cache)
+
+    def emit(self, r, text, final=False):
+        # stream the text, except for the trailing characters that could still become a stop string,
+        # and return True if a stop string matched (the text from it on is never sent, as without streaming)
+        if r.pending is None:
+            return True
+        r.pending += text
+        cut = min((i for s in r.stop if (i := r.pending.find(s)) >= 0), default=None)
+        n = cut if cut is not None else len(r.pending) if final else max(0, len(r.pending) - r.hold)
+        if n:
+            r.events.put(r.pending[:n])
+        r.pending = None if cut is not None else r.pending[n:]
+        return cut is not None
+
+    def finish(self, r, now):
+        self.emit(r, r.detokenizer.flush(), final=True)
+        r.events.put(None)
+        with self.cond: # stats() reads these from the HTTP threads
+            self.completed += 1
+            self.latencies.append(now - r.t_submit)
+            self.ttfts.append(r.t_first - r.t_submit)
+
+    def fail(self, r):
+        r.finish_reason = 'error'
+        r.events.put(None)
+        with self.cond:
+            self.completed += 1
+
+    def record_tokens(self, now, n):
+        with self.cond:
+            self.tokens_total += n
+            self.token_times.append((now, n))
+            while self.token_times and self.token_times[0][0] < now - 10.0:
+                self.token_times.popleft()
+
+    def stats(self):
+        now = time.time()
+        with self.cond: # snapshot, the scheduler thread keeps appending
+            token_times, latencies, ttfts = list(self.token_times), list(self.latencies), list(self.ttfts)
+        window = [n for t, n in token_times if t >= now - 10.0]
+        elapsed = min(10.0, now - self.t_start)
+        return {
+            'active': len(self.active),
+            'waiting': len(self.waiting),
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'tokens_total': self.tokens_total,
+            'tokens_per_sec': sum(window) / elapsed if elapsed > 0 else 0.0, # over the last 10 seconds
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99),
+            'ttft_p50': percentile(ttfts, 50),
+            'ttft_p99': percentile(ttfts, 99),
+            'prefix_cache': self.prefix_cache.stats() if self.prefix_cache is not None else None,
+        }
+
+class Handler(BaseHTTPRequestHandler):
+
+    scheduler = None # set before the server starts
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send_json(200, self.scheduler.stats())
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        if self.path != '/v1/completions':
+            self.send_json(404, {'error': 'not found'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            stop = body.get('stop') or []
+            stop = [stop] if isinstance(stop, str) else [s for s in stop if s]
+            k = body.get('top_k', top_k)
+            p = body.get('top_p', top_p)
+            penalty = body.get('repetition_penalty', repetition_penalty)
+            t = float(body.get('temperature', temperature))
+            k = None if k is None else int(k)
+            p = None if p is None else float(p)
+            penalty = None if penalty is None else float(penalty)
+            # a bad setting would otherwise only fail on the scheduler thread, in the middle of a batch
+            if not (math.isfinite(t) and t >= 0):
+                raise ValueError("temperature must be a finite number >= 0")
+            if k is not None and k < 1:
+                raise ValueError("top_k must be >= 1")
+            if p is not None and not 0 < p <= 1:
+                raise ValueError("top_p must be in (0, 1]")
+            if penalty is not None and not (math.isfinite(penalty) and penalty > 0):
+                raise ValueError("repetition_penalty must be a finite number > 0")
+            req = self.scheduler.submit(
+                str(body.get('prompt', '\n')),
+                int(body.get('max_tokens', max_tokens)),
+                t, k, p, penalty, stop,
+            )
+        except (ValueError, TypeError, AttributeError, KeyError) as e: # KeyError: a character outside a char vocab
+            self.send_json(400, {'error': f'bad request: {e}'})
+            return
+        if req is None:
+            self.send_json(503, {'error': 'server busy, try again later'})
+            return
+
+        if body.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.end_headers()
+            try:
+                while (piece := req.events.get()) is not None:
+                    self.wfile.write((json.dumps({'text': piece}) + '\n').encode())
+                    self.wfile.flush()
+                self.wfile.write((json.dumps({'done': True, 'finish_reason': req.finish_reason}) + '\n').encode())
+            except (BrokenPipeError, ConnectionResetError):
+                req.cancelled = True
+        else:
+            pieces = []
+            while (piece := req.events.get()) is not None:
+                pieces.append(piece)
+            self.send_json(200, {'text': ''.join(pieces), 'tokens': len(req.tokens), 'finish_reason': req.finish_reason})
+
+    def log_message(self, format, *args):
+        pass # keep the console quiet, /stats has the numbers
+
+if __name__ == '__main__':
+    exec(open('configurator.py').read()) # overrides from command line or config file
+
+    torch.manual_seed(seed)
+    torch.cuda.manual_seed(seed)
+    torch.backends.cuda.matmul.allow_tf32 = True # allow tf32 on matmul
+    torch.backends.cudnn.allow_tf32 = True # allow tf32 on cudnn
+    device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+    ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+    ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+    model, meta_path = load_model(init_from, out_dir, device)
+    if compile:
+        model = torch.compile(model) # requires PyTorch 2.0 (optional)
+    codec = get_codec(meta_path)
+    # with GPT-2 encodings a sample ends at <|endoftext|>
+    stop_tokens = set() if meta_path else {50256}
+
+    prefix_cache = PrefixCache(prefix_cache_mb * 1024**2) if prefix_cache_mb > 0 else None
+    scheduler = Scheduler(model, codec, stop_tokens, ctx, prefix_cache)
+    threading.Thread(target=scheduler.run, daemon=True).start()
+    Handler.scheduler = scheduler
+    server = ThreadingHTTPServer((host, port), Handler)
+    print(f"serving on http://{host}:{port}/v1/completions (stats at /stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
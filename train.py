@@ -10,6 +10,12 @@ $ python train.py --batch_size=32 --compile=False
 To run with DDP on 4 gpus on 1 node, example:
 $ torchrun --standalone --nproc_per_node=4 train.py
 
+To test DDP on the cpu, e.g. with the AdamW state sharded across 2 processes:
+$ torchrun --standalone --nproc_per_node=2 train.py --device=cpu --backend=gloo --compile=False --zero_optimizer=True
+
+To shard the parameters, gradients and optimizer state of every Block across the gpus with FSDP:
+$ torchrun --standalone --nproc_per_node=4 train.py --parallelism=fsdp
+
 To run with DDP on 4 gpus across 2 nodes, example:
 - Run on the first (master) node with example IP 123.456.123.456:
 $ torchrun --nproc_per_node=8 --nnodes=2 --node_rank=0 --master_addr=123.456.123.456 --master_port=1234 train.py
@@ -22,6 +28,8 @@ import os
 import time
 import math
 import pickle
+import gc
+import itertools
 from contextlib import nullcontext
 import atexit
 
@@ -31,6 +39,9 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
+from loader import BatchLoader, WindowSampler, fixed_windows
+from dataset import open_tokens
+import ckpt
 from sample import generate_sample
 
 # -----------------------------------------------------------------------------
@@ -40,8 +51,13 @@ out_dir = 'out'
 eval_interval = 2000
 log_interval = 1
 eval_iters = 200
+eval_mode = 'random' # 'random': eval_iters new random batches per split, on the master process only (all processes with fsdp)
+                     # 'fixed': the same eval_iters * batch_size windows at every eval, split between all processes
+eval_batch_size = 0 # batch size of the 'fixed' evals, can be larger than batch_size since there are no gradients; 0 = batch_size
 eval_only = False # if True, script exits right after the first eval
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
+ckpt_format = 'torch' # 'torch' (one pickled ckpt.pt) or 'mmap' (memory-mappable ckpt_model.bin + ckpt_optim.bin, see ckpt.py)
+async_checkpoint = True # snapshot checkpoints to cpu memory and write them to disk on a background thread
 init_from = 'scratch' # 'scratch' or 'resume' or 'gpt2*'
 output_sample = False  # print sample output for each eval
 # wandb logging
@@ -53,12 +69,17 @@ dataset = 'openwebtext'
 gradient_accumulation_steps = 5 * 8 # used to simulate larger batch sizes
 batch_size = 12 # if gradient_accumulation_steps > 1, this is the micro-batch size
 block_size = 1024
+loader_workers = 1 # threads that gather batches in the background
+loader_prefetch = 4 # batches every loader thread keeps ready
 # model
 n_layer = 12
 n_head = 12
 n_embd = 768
 dropout = 0.0 # for pretraining 0 is good, for finetuning try 0.1+
 bias = False # do we use bias inside LayerNorm and Linear layers?
+loss_chunk_size = 0 # if > 0, compute lm_head + loss in chunks of this many tokens, never materializing the full logits
+activation_checkpoint = '' # recompute activations in backward to save memory: '' (off), 'block' (whole Blocks) or 'attn' (attention only)
+activation_checkpoint_every = 1 # checkpoint only every k-th Block, e.g. 2 = half of them
 # adamw optimizer
 learning_rate = 6e-4 # max learning rate
 max_iters = 600000 # total number of training iterations
@@ -73,6 +94,9 @@ lr_decay_iters = 600000 # should be ~= max_iters per Chinchilla
 min_lr = 6e-5 # minimum learning rate, should be ~= learning_rate/10 per Chinchilla
 # DDP settings
 backend = 'nccl' # 'nccl', 'gloo', etc.
+parallelism = 'ddp' # 'ddp' (every rank holds the whole model) or 'fsdp' (shard the parameters, gradients and optimizer state per Block)
+fsdp_checkpoint = 'full' # with fsdp: 'full' (gathered onto rank 0 into a regular checkpoint) or 'sharded' (every rank writes its own shards)
+zero_optimizer = False # shard the AdamW state across the ranks (ZeRO stage 1), every rank checkpoints its own shard
 # system
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1' etc., or try 'mps' on macbooks
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32', 'bfloat16', or 'float16', the latter will auto implement a GradScaler
@@ -90,8 +114,10 @@ if ddp:
     ddp_rank = int(os.environ['RANK'])
     ddp_local_rank = int(os.environ['LOCAL_RANK'])
     ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device = f'cuda:{ddp_local_rank}'
-    torch.cuda.set_device(device)
+    if device.startswith('cuda'):
+        device = f'cuda:{ddp_local_rank}'
+        torch.cuda.set_device(device)
+    # else e.g. device='cpu' with backend='gloo', handy for testing distributed training on one machine
     master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
     seed_offset = ddp_rank # each process gets a different seed
     # world_size number of processes will be training simultaneously, so we can scale
@@ -102,7 +128,12 @@ else:
     # if not ddp, we are running on a single gpu, and one process
     master_process = True
     seed_offset = 0
+    ddp_rank = 0
     ddp_world_size = 1
+fsdp = ddp and parallelism == 'fsdp'
+zero = ddp and zero_optimizer
+assert not (fsdp and zero_optimizer), "fsdp already shards the optimizer state"
+assert eval_mode in ('random', 'fixed')
 tokens_per_iter = gradient_accumulation_steps * ddp_world_size * batch_size * block_size
 print(f"tokens per iteration will be: {tokens_per_iter:,}")
 
@@ -116,21 +147,13 @@ device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.aut
 ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
-# poor man's data loader
+# data, a single train.bin / val.bin or a sharded dataset, see dataset.py. training walks a permutation
+# of the non-overlapping windows of the train split, split between the ranks, and its position goes
+# into the checkpoint so that resuming never repeats or skips tokens
 data_dir = os.path.join('data', dataset)
-train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-val_data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-def get_batch(split):
-    data = train_data if split == 'train' else val_data
-    ix = torch.randint(len(data) - block_size, (batch_size,))
-    x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y
+train_data = open_tokens(data_dir, 'train')
+val_data = open_tokens(data_dir, 'val')
+train_sampler = WindowSampler(len(train_data), block_size, batch_size, rank=ddp_rank, world_size=ddp_world_size)
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
@@ -147,7 +170,9 @@ if os.path.exists(meta_path):
 
 # model init
 model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=block_size,
-                  bias=bias, vocab_size=None, dropout=dropout) # start with model_args from command line
+                  bias=bias, vocab_size=None, dropout=dropout, loss_chunk_size=loss_chunk_size,
+                  activation_checkpoint=activation_checkpoint,
+                  activation_checkpoint_every=activation_checkpoint_every) # start with model_args from command line
 if init_from == 'scratch':
     # init a new model from scratch
     print("Initializing a new model from scratch")
@@ -159,9 +184,13 @@ if init_from == 'scratch':
     model = GPT(gptconf)
 elif init_from == 'resume':
     print(f"Resuming training from {out_dir}")
-    # resume training from a checkpoint.
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-    checkpoint = torch.load(ckpt_path, map_location=device)
+    # resume training from a checkpoint, the latest one of either format (ckpt_format only decides how
+    # the next ones are written, an out_dir may have been trained on with the other format before)
+    if ckpt.is_latest(out_dir):
+        checkpoint = ckpt.load_checkpoint(out_dir)
+    else:
+        ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+        checkpoint = torch.load(ckpt_path, map_location='cpu' if fsdp else device) # fsdp moves only the shards to the device
     checkpoint_model_args = checkpoint['model_args']
     # force these config attributes to be equal otherwise we can't even resume training
     # the rest of the attributes (e.g. dropout) can stay as desired from command line
@@ -170,20 +199,22 @@ elif init_from == 'resume':
     # create the model
     gptconf = GPTConfig(**model_args)
     model = GPT(gptconf)
-    state_dict = checkpoint['model']
-    # fix the keys of the state dictionary :(
-    # honestly no idea how checkpoints sometimes get this prefix, have to debug more
-    unwanted_prefix = '_orig_mod.'
-    for k,v in list(state_dict.items()):
-        if k.startswith(unwanted_prefix):
-            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    if not checkpoint.get('sharded'): # else the weights are loaded after sharding the model, see below
+        state_dict = checkpoint['model']
+        # fix the keys of the state dictionary :(
+        # honestly no idea how checkpoints sometimes get this prefix, have to debug more
+        unwanted_prefix = '_orig_mod.'
+        for k,v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+        model.load_state_dict(state_dict)
     iter_num = checkpoint['iter_num']
     best_val_loss = checkpoint['best_val_loss']
 elif init_from.startswith('gpt2'):
     print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
     # initialize from OpenAI GPT-2 weights
-    override_args = dict(dropout=dropout)
+    override_args = dict(dropout=dropout, loss_chunk_size=loss_chunk_size, activation_checkpoint=activation_checkpoint,
+                         activation_checkpoint_every=activation_checkpoint_every)
     model = GPT.from_pretrained(init_from, override_args)
     # read off the created config params, so we can store them into checkpoint correctly
     for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
@@ -192,17 +223,65 @@ elif init_from.startswith('gpt2'):
 if block_size < model.config.block_size:
     model.crop_block_size(block_size)
     model_args['block_size'] = block_size # so that the checkpoint will have the right value
-model.to(device)
+if fsdp:
+    from torch.distributed.fsdp import fully_shard, MixedPrecisionPolicy
+    from torch.distributed.device_mesh import init_device_mesh
+    # like DDP, start all ranks from the weights of rank 0 (the ranks are seeded differently)
+    for t in itertools.chain(model.parameters(), model.buffers()):
+        t_device = t.detach().to(device)
+        torch.distributed.broadcast(t_device, 0)
+        t.data.copy_(t_device)
+    # every Block is its own FSDP unit, so only one Block at a time is gathered in full. the rest,
+    # including the tied wte / lm_head weight, is sharded as part of the root unit. this moves the
+    # shards to the device, the model never exists there in full
+    mesh = init_device_mesh(device_type, (ddp_world_size,))
+    # on the gpu, gather the parameters in the autocast dtype but reduce the gradients in fp32
+    mp_policy = MixedPrecisionPolicy(param_dtype=ptdtype, reduce_dtype=torch.float32) if device_type == 'cuda' else MixedPrecisionPolicy()
+    for block in model.transformer.h:
+        fully_shard(block, mesh=mesh, mp_policy=mp_policy)
+    fully_shard(model, mesh=mesh, mp_policy=mp_policy)
+else:
+    model.to(device)
 
 # initialize a GradScaler. If enabled=False scaler is a no-op
-scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
+if fsdp:
+    from torch.distributed.fsdp.sharded_grad_scaler import ShardedGradScaler
+    scaler = ShardedGradScaler(enabled=(dtype == 'float16')) # looks for infs/nans across the shards of all ranks
+else:
+    scaler = torch.cuda.amp.GradScaler(enabled=(dtype == 'float16'))
 
 # optimizer
-optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
+optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type, zero=zero)
 if init_from == 'resume':
-    optimizer.load_state_dict(checkpoint['optimizer'])
+    if checkpoint.get('sharded'):
+        # weights and optimizer state written by the ranks of an fsdp run, possibly a different number of them
+        ckpt.load_sharded(model, optimizer, out_dir, checkpoint['iter_num'])
+    elif 'optimizer_shards' in checkpoint:
+        # sharded optimizer state, possibly written by a different number of ranks
+        assert not fsdp, "resume from a ZeRO checkpoint without fsdp, the next checkpoint can then be resumed with it"
+        ckpt.load_optimizer_shards(optimizer, model, out_dir, checkpoint['optimizer_shards'], checkpoint['iter_num'])
+    elif fsdp:
+        ckpt.load_full_optimizer_state_dict(optimizer, model, checkpoint['optimizer'])
+    else:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if 'data' in checkpoint:
+        train_sampler.load_state_dict(checkpoint['data']) # continue with the first window not trained on yet
 checkpoint = None # free up memory
 
+# data loaders, threads gather the batches in the background, see loader.py
+train_loader = BatchLoader(train_data, block_size, batch_size, device, sample=train_sampler,
+                           num_workers=loader_workers, prefetch=loader_prefetch)
+if eval_mode == 'fixed':
+    # the same windows at every eval, also across runs and numbers of processes, so evals of different
+    # checkpoints are comparable. every process keeps its share on the device, nothing is loaded later
+    eval_data = {split: fixed_windows(data, block_size, eval_iters * batch_size, ddp_rank, ddp_world_size).to(device)
+                 for split, data in [('train', train_data), ('val', val_data)]}
+else:
+    # evals use random windows, different ones at every eval, but the same ones again after resuming
+    eval_loaders = {split: BatchLoader(data, block_size, batch_size, device, seed=1337 + seed_offset,
+                                       start=iter_num // eval_interval * eval_iters)
+                    for split, data in [('train', train_data), ('val', val_data)]}
+
 # compile the model
 if compile:
     print("compiling the model... (takes a ~minute)")
@@ -210,22 +289,43 @@ if compile:
     model = torch.compile(model) # requires PyTorch 2.0
 
 # wrap model into DDP container
-if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
+if ddp and not fsdp:
+    model = DDP(model, device_ids=[ddp_local_rank] if device.startswith('cuda') else None)
 
 # helps estimate an arbitrarily accurate loss over either split using many batches
 @torch.no_grad()
 def estimate_loss():
     out = {}
     model.eval()
+    if eval_mode == 'fixed':
+        # the summed losses and the number of tokens of both splits, on the device, so there is no sync
+        # per batch and a single all-reduce at the end, which also weighs every process by its tokens
+        totals = torch.zeros(2, 2, device=device)
+        for i, split in enumerate(['train', 'val']):
+            for batch in eval_data[split].split(eval_batch_size or batch_size):
+                X, Y = batch[:, :-1].contiguous(), batch[:, 1:].contiguous()
+                with ctx:
+                    logits, loss = model(X, Y)
+                totals[i, 0] += loss.float() * Y.numel()
+                totals[i, 1] += Y.numel()
+        if ddp:
+            torch.distributed.all_reduce(totals)
+        out['train'], out['val'] = (totals[:, 0] / totals[:, 1]).tolist()
+        model.train()
+        return out
     for split in ['train', 'val']:
         losses = torch.zeros(eval_iters)
         for k in range(eval_iters):
-            X, Y = get_batch(split)
+            X, Y = next(eval_loaders[split])
             with ctx:
                 logits, loss = model(X, Y)
             losses[k] = loss.item()
         out[split] = losses.mean()
+        if fsdp:
+            # every rank evaluated its own batches, average them (on the device, NCCL rejects CPU tensors)
+            mean = out[split].to(device)
+            torch.distributed.all_reduce(mean)
+            out[split] = mean.cpu() / ddp_world_size
     model.train()
     return out
 
@@ -252,11 +352,16 @@ if wandb_log and master_process:
         atexit.register(lambda: wandb.log({"output": sample_table}))
 
 # training loop
-X, Y = get_batch('train') # fetch the very first batch
+X, Y = next(train_loader) # fetch the very first batch
 t0 = time.time()
+wait_time0 = train_loader.wait_time
 local_iter_num = 0 # number of iterations in the lifetime of this process
-raw_model = model.module if ddp else model # unwrap DDP container if needed
+if fsdp:
+    raw_model = unoptimized_model if compile else model # the fsdp-sharded GPT itself
+else:
+    raw_model = model.module if ddp else model # unwrap DDP container if needed
 running_mfu = -1.0
+checkpointer = ckpt.AsyncCheckpointer() if async_checkpoint and (master_process or zero) else None
 while True:
 
     # determine and set the learning rate for this iteration
@@ -265,37 +370,65 @@ while True:
         param_group['lr'] = lr
 
     # evaluate the loss on train/val sets and write checkpoints
-    if iter_num % eval_interval == 0 and master_process:
+    saving = False
+    if iter_num % eval_interval == 0 and (master_process or fsdp or eval_mode == 'fixed'):
+        # with fsdp every forward pass needs all ranks, and fixed evals are split between all of them
         losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-        if wandb_log:
-            wandb.log({
-                "iter": iter_num,
-                "train/loss": losses['train'],
-                "val/loss": losses['val'],
-                "lr": lr,
-                "mfu": running_mfu*100, # convert to percentage
-            })
+    if iter_num % eval_interval == 0 and (master_process or fsdp):
+        if master_process:
+            print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
+            if wandb_log:
+                wandb.log({
+                    "iter": iter_num,
+                    "train/loss": losses['train'],
+                    "val/loss": losses['val'],
+                    "lr": lr,
+                    "mfu": running_mfu*100, # convert to percentage
+                })
         if losses['val'] < best_val_loss or always_save_checkpoint:
             best_val_loss = losses['val']
             if iter_num > 0:
+                saving = True
+                if master_process:
+                    print(f"saving checkpoint to {out_dir}")
                 checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
                     'model_args': model_args,
                     'iter_num': iter_num,
                     'best_val_loss': best_val_loss,
+                    # X, Y of this iteration are fetched already, but not trained on
+                    'data': train_sampler.state_dict(train_loader.k - 1),
                     'config': config,
                 }
-                print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
+                if fsdp and fsdp_checkpoint == 'sharded':
+                    # every rank writes its own shards of the weights and optimizer state, the master the rest
+                    ckpt.save_sharded(raw_model, optimizer, out_dir, iter_num)
+                    checkpoint['sharded'] = True
+                elif fsdp:
+                    # gather everything onto the master, into the same checkpoint as without fsdp
+                    checkpoint['model'], checkpoint['optimizer'] = ckpt.full_state_dict(raw_model, optimizer)
+                else:
+                    checkpoint['model'] = raw_model.state_dict()
+                    if zero:
+                        checkpoint['optimizer_shards'] = ddp_world_size # every rank writes its own shard, see below
+                    else:
+                        checkpoint['optimizer'] = optimizer.state_dict()
+                if master_process:
+                    if ckpt_format == 'mmap':
+                        write = lambda c: ckpt.save_checkpoint(c, out_dir)
+                    else:
+                        write = lambda c: ckpt.save_torch(c, os.path.join(out_dir, 'ckpt.pt'))
+                    if checkpointer is not None:
+                        checkpointer.save(checkpoint, write)
+                    else:
+                        write(checkpoint)
 
-                if output_sample:
+                # with fsdp the other ranks would have to take part in every forward pass of the sampling
+                if output_sample and master_process and not fsdp:
                     generator = generate_sample(
                         model=raw_model,
                         max_new_tokens=250,
                         device=device,
-                        meta_path=os.path.join("data", checkpoint["config"]["dataset"], "meta.pkl"),
+                        meta_path=meta_path if meta_vocab_size is not None else None, # else GPT-2 encodings
                     )
                     sample = "".join(generator).strip()
                     print("sample:", sample.replace("\n", " ")[:50] + "...")
@@ -303,23 +436,37 @@ while True:
                     if wandb_log and sample:
                         sample_table.add_data(iter_num, sample)
 
+    if zero and iter_num % eval_interval == 0 and iter_num > 0:
+        # the other ranks learn from the master process whether a checkpoint is being saved, and if
+        # so all of them write the shard of the optimizer state they own, in parallel
+        saving = torch.tensor(int(saving), device=device)
+        torch.distributed.broadcast(saving, 0)
+        if saving.item():
+            shard = ckpt.optimizer_shard(optimizer, raw_model, iter_num)
+            write = lambda s: ckpt.save(s, ckpt.shard_path(out_dir, ddp_rank, ddp_world_size))
+            if checkpointer is not None:
+                checkpointer.save(shard, write)
+            else:
+                write(shard)
+
     if iter_num == 0 and eval_only:
         break
 
     # forward backward update, with optional gradient accumulation to simulate larger batch size
     # and using the GradScaler if data type is float16
     for micro_step in range(gradient_accumulation_steps):
-        if ddp:
+        if ddp and not fsdp:
             # in DDP training we only need to sync gradients at the last micro step.
             # the official way to do this is with model.no_sync() context manager, but
             # I really dislike that this bloats the code and forces us to repeat code
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
+        # (fsdp instead reduce-scatters the gradients after every micro step, so that they stay sharded)
         with ctx:
             logits, loss = model(X, Y)
             loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
-        # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y = get_batch('train')
+        # take the next batch (already gathered by the loader) while model is doing the forward pass on the GPU
+        X, Y = next(train_loader)
         # backward pass, with gradient scaling if training in fp16
         scaler.scale(loss).backward()
     # clip the gradient
@@ -336,14 +483,23 @@ while True:
     t1 = time.time()
     dt = t1 - t0
     t0 = t1
+    # time the training loop spent waiting for the loader, should be ~0
+    data_wait = train_loader.wait_time - wait_time0
+    wait_time0 = train_loader.wait_time
     if iter_num % log_interval == 0 and master_process:
         # get loss as float. note: this is a CPU-GPU sync point
         # scale up to undo the division above, approximating the true total loss (exact would have been a sum)
         lossf = loss.item() * gradient_accumulation_steps
         if local_iter_num >= 5: # let the training loop settle a bit
+            # per gpu: the micro-batches of this rank, and the number of parameters of the whole model (also when sharded)
             mfu = raw_model.estimate_mfu(batch_size * gradient_accumulation_steps, dt)
             running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
-        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%")
+        mem = ""
+        if device_type == 'cuda':
+            # peak memory since the last log, to see what activation_checkpoint / loss_chunk_size save
+            mem = f", mem {torch.cuda.max_memory_allocated(device) / 1024**3:.2f}GiB"
+            torch.cuda.reset_peak_memory_stats(device)
+        print(f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, data wait {data_wait*1000:.2f}ms, tok/s {tokens_per_iter/dt:,.0f}, mfu {running_mfu*100:.2f}%{mem}")
     iter_num += 1
     local_iter_num += 1
 
@@ -351,5 +507,12 @@ while True:
     if iter_num > max_iters:
         break
 
+if checkpointer is not None:
+    checkpointer.wait() # make sure the last checkpoint is on disk
 if ddp:
+    if zero:
+        # the ZeroRedundancyOptimizer is part of a reference cycle, collect it while the process group is
+        # still around, at interpreter shutdown its destruction aborts the process
+        optimizer = None
+        gc.collect()
     destroy_process_group()